@@ -0,0 +1,53 @@
+import os
+import json
+import hashlib
+
+# Written next to the token shards by preprocess.py
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(path):
+    '''sha256 of the file's contents, as hex'''
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer, **params):
+    """
+    Hash of everything that decides the token ids of a file: the tokenizer class, its config and vocab, and
+    any other parameters of the tokenization (e.g. how scores are resampled first).
+
+    :param params: other parameters of the tokenization, JSON serializable
+    :return: hex digest
+    """
+    description = {
+        "tokenizer": type(tokenizer).__name__,
+        "config": tokenizer.config.to_dict(serialize=True),
+        "vocab": tokenizer.vocab,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_manifest(path, fingerprint):
+    """
+    Content hashes of the files a previous run tokenized, if it used the same tokenizer.
+
+    :param path: manifest file, which does not have to exist
+    :param fingerprint: tokenizer_fingerprint of this run
+    :return: {file name: content hash}, empty if there is no manifest or the tokenizer changed
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("fingerprint") != fingerprint:
+        return {}
+    return manifest["files"]
+
+
+def save_manifest(path, fingerprint, hashes):
+    '''Writes the manifest of a run; replaced in one step, so an interrupted write keeps the old one'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"fingerprint": fingerprint, "files": hashes}, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,85 @@
+import numpy as np
+
+# MAX_SEGMENTS is main.py's --max_segments default, which has to be at least what the shards were packed with
+MIN_SEGMENT_LENGTH = 8
+MAX_SEGMENTS = 8
+
+
+def packed_rows(tokenized_files, window_size, max_segments=MAX_SEGMENTS, min_segment_length=MIN_SEGMENT_LENGTH):
+    """
+    Rows of the packed shards: first every full (input, label) window as a row of its own, streamed one file
+    at a time like window_pairs in preprocess.py, then the file ends the windows leave over, packed together
+    by pack_segments. Only those ends (less than two windows per file) are held in memory.
+
+    :param tokenized_files: token id arrays, read twice, e.g. preprocess.collect_tokenized_midi_files()
+    :return: generator of [num_rows x 3 x window_size] blocks of rows, see pack_segments
+    """
+    for file in tokenized_files:
+        file = np.asarray(file)
+        num_windows = len(file) // (window_size * 2)
+        if num_windows:
+            rows = np.ones([num_windows, 3, window_size], dtype=file.dtype)
+            rows[:, :2] = file[:num_windows * window_size * 2].reshape(num_windows, 2, window_size)
+            yield rows
+    segments = tail_segments(tokenized_files, window_size, min_segment_length)
+    for row in pack_segments(segments, window_size, max_segments):
+        yield row[np.newaxis]
+
+
+def tail_segments(tokenized_files, window_size, min_segment_length=MIN_SEGMENT_LENGTH):
+    """
+    What is left of every file after its full (input, label) windows (or a whole file shorter than two
+    windows), as one shorter pair with two equal halves, if the halves have at least min_segment_length tokens.
+
+    :return: list of (input tokens, label tokens) segments, the two of the same length
+    """
+    segments = []
+    for file in tokenized_files:
+        end = len(file) - len(file) % (window_size * 2)
+        half = (len(file) - end) // 2
+        if half >= min_segment_length:
+            segments.append((file[end:end + half], file[end + half:end + half * 2]))
+    return segments
+
+
+def pack_segments(segments, window_size, max_segments=MAX_SEGMENTS):
+    """
+    Packs segments into rows of window_size tokens, best-fit decreasing: longest segments first, each into
+    the open row it fills the most. Full windows get a row of their own (packed_rows streams those instead).
+
+    Only the assignment of segments to rows is held in memory; the rows are built as they are consumed,
+    e.g. by shards.write_packed_shards.
+
+    :param segments: (input tokens, label tokens) pairs, e.g. from tail_segments
+    :param max_segments: most segments per row, i.e. melody contexts the model attends to per row
+    :return: generator of int32 rows [3 x window_size]: input tokens, label tokens and segment ids
+        (1..max_segments for tokens of the row's segments, 0 for padding)
+    """
+    rows = []
+    free = []
+    # open_rows[n]: rows with n free positions that can still take a segment
+    open_rows = [[] for _ in range(window_size + 1)]
+    for index in sorted(range(len(segments)), key=lambda i: -len(segments[i][0])):
+        length = len(segments[index][0])
+        fit = next((space for space in range(length, window_size + 1) if open_rows[space]), None)
+        if fit is None:
+            row = len(rows)
+            rows.append([])
+            free.append(window_size)
+        else:
+            row = open_rows[fit].pop()
+        rows[row].append(index)
+        free[row] -= length
+        if free[row] and len(rows[row]) < max_segments:
+            open_rows[free[row]].append(row)
+
+    for members in rows:
+        packed = np.zeros([3, window_size], dtype=np.int32)
+        start = 0
+        for segment_id, index in enumerate(members, 1):
+            input_ids, label_ids = segments[index]
+            packed[0, start:start + len(input_ids)] = input_ids
+            packed[1, start:start + len(label_ids)] = label_ids
+            packed[2, start:start + len(input_ids)] = segment_id
+            start += len(input_ids)
+        yield packed
@@ -6,6 +6,11 @@ from symusic import Score
 import pickle
 from concurrent.futures import ProcessPoolExecutor
 
+from shards import write_pair_shards, write_packed_shards
+from token_shards import write_token_shards, TokenShards
+from manifest import MANIFEST_NAME, file_hash, tokenizer_fingerprint, load_manifest, save_manifest
+from packing import packed_rows
+
 # This script differs from valid_midi.py in that we use an alternative dataset instead of the Lakh-based dataset.
 # Since this dataset does not have the same two-channel structure, we will do some crude assumptions and split 
 # melody and harmony off of of the average pitch of the midi file.
@@ -19,63 +24,112 @@ tokenizer = Structured(config)
 data_folder = "src/data_preprocessing"
 raw_data_path = "src/data_preprocessing/raw_midi"
 tokenized_data_path = "src/data_preprocessing/tokenized_midi"
+# Tokens per input (and label) window, and tokens from the start of one pair to the next
+window_size = 64
+window_stride = window_size * 2
+# Scores are resampled to this many ticks per quarter before tokenizing
+resample_tpq = 6
+resample_min_dur = 1
 count = 0
 midi_tokens_list = []  
 break_out = False
 
-midi_filepaths = [os.path.join(root, file) for root, _, files in os.walk(raw_data_path) for file in files if (file.endswith('.mid') or file.endswith('.midi'))]
+midi_filepaths = sorted(os.path.join(root, file) for root, _, files in os.walk(raw_data_path) for file in files if (file.endswith('.mid') or file.endswith('.midi')))
+
+def midi_name(file_path: str) -> str:
+    '''Name of a MIDI file in the token shards and manifest: its path under raw_midi/, unique unlike the basename'''
+    return os.path.relpath(file_path, raw_data_path).replace(os.sep, '/')
 
-def tokenize_midi(file_path: str) -> None:
+def tokenize_midi(file_path: str):
+    """
+    :return: (file name, token ids of the first track as uint16), None if the file cannot be parsed
+    """
     try:
-        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        file_name = midi_name(file_path)
         midi_score = Score(file_path)
-        midi_score = midi_score.resample(tpq=6, min_dur=1)
+        midi_score = midi_score.resample(tpq=resample_tpq, min_dur=resample_min_dur)
         midi_tokens = tokenizer(midi_score)
-        with open(os.path.join(tokenized_data_path, file_name + ".pkl"), 'wb') as f:
-            pickle.dump(midi_tokens, f)
+        return file_name, np.asarray(midi_tokens[0].ids, dtype=np.uint16)
     except Exception as e:
         print("UB occured when parsing:", file_path)
         print(e)
+        return None
 
 
-def collect_tokenized_midi_files() -> list:
-    tokenized_files = []
-    for root, _, files in os.walk(tokenized_data_path):
-        for file in files:
-            if file.endswith('.pkl'):
-                file_path = os.path.join(root, file)
-                with open(file_path, 'rb') as f:
-                    tokenized_file = pickle.load(f)
-                    tokenized_file = tokenized_file[0].ids
-                    tokenized_files.append(tokenized_file)
-    return tokenized_files
-
-def split_tokens_into_pairs(tokenized_files, window_size):
-    input_pairs = []
-    label_pairs = []
-    for file in tokenized_files:
-        for i in range(0, len(file) - window_size*2, window_size*2):
-            print("did something")
-            input_pairs.append(file[i:i+window_size])
-            label_pairs.append(file[i+window_size:i+window_size*2])
-    return input_pairs, label_pairs
+def tokenize_changed_files(executor, hashes, previous_hashes):
+    """
+    Token ids of every MIDI file, in midi_filepaths order: files whose content hash is the one in the
+    previous run's manifest, and whose tokens are in the current token shards, are read back from the shards;
+    the others (new, changed, or failed to parse before) are tokenized by the executor. Files that were
+    deleted are simply not yielded.
 
+    :param hashes: {file name: content hash} of every MIDI file
+    :param previous_hashes: load_manifest of the previous run, empty to tokenize everything
+    :return: generator of (file name, token ids), for write_token_shards
+    """
+    previous = collect_tokenized_midi_files() if previous_hashes else None
+    previous_index = {name: index for index, name in enumerate(previous.names)} if previous else {}
+    unchanged = {name for name, digest in hashes.items() if name in previous_index and previous_hashes.get(name) == digest}
+    changed_paths = [path for path in midi_filepaths if midi_name(path) not in unchanged]
+    print("Reusing", len(unchanged), "tokenized files, tokenizing", len(changed_paths), "new or changed files,",
+          "dropping", len(set(previous_hashes) - set(hashes)), "deleted files")
+    tokenized = executor.map(tokenize_midi, changed_paths, chunksize=16)
+    for path in tqdm(midi_filepaths, desc="Tokenizing"):
+        name = midi_name(path)
+        if name not in unchanged:
+            result = next(tokenized)
+            if result is not None:
+                yield result
+        else:
+            yield name, previous[previous_index[name]]
 
 
+def collect_tokenized_midi_files() -> TokenShards:
+    '''Token ids of every tokenized file, memory-mapped from the token shards'''
+    return TokenShards(tokenized_data_path)
+
+def window_pairs(tokenized_files, window_size, stride=None):
+    """
+    Streams the (input, label) window pairs of every file: each window of 2 * window_size tokens starting at
+    a multiple of stride, the input being its first half and the label its second. Windows are strided views
+    into the file's tokens, so nothing is copied until the pairs are written.
+
+    :param tokenized_files: iterable of token id arrays, e.g. collect_tokenized_midi_files()
+    :param stride: tokens from the start of one window to the next, 2 * window_size (no overlap) by default
+    :return: generator of [num_pairs x 2 x window_size] arrays, one per file long enough for a window
+    """
+    stride = stride or window_size * 2
+    for file in tokenized_files:
+        file = np.asarray(file)
+        if len(file) < window_size * 2:
+            continue
+        windows = np.lib.stride_tricks.sliding_window_view(file, window_size * 2)[::stride]
+        yield windows.reshape(len(windows), 2, window_size)
 
 
 if __name__ == '__main__':
+    # Only files that are new or changed since the last run (by content hash) are tokenized, unless the
+    # tokenizer changed. Workers send the token ids back and they are appended to the token shards in order.
+    manifest_path = os.path.join(tokenized_data_path, MANIFEST_NAME)
+    fingerprint = tokenizer_fingerprint(tokenizer, tpq=resample_tpq, min_dur=resample_min_dur)
     with ProcessPoolExecutor() as executor:
-        executor.map(tokenize_midi, midi_filepaths)
+        hashes = dict(zip(map(midi_name, midi_filepaths), executor.map(file_hash, midi_filepaths, chunksize=64)))
+        tokenized = tokenize_changed_files(executor, hashes, load_manifest(manifest_path, fingerprint))
+        write_token_shards(tokenized, tokenized_data_path)
+    # Written after the shards, so a run that stops early is redone rather than trusted
+    save_manifest(manifest_path, fingerprint, hashes)
     with open('src/data_preprocessing/tokenizers/tokenizer.pkl', 'wb') as f:
         pickle.dump(tokenizer, f)
     print("Tokenized files")
     collected_files = collect_tokenized_midi_files()
     print(len(collected_files))
-    input_tokens, label_tokens = split_tokens_into_pairs(collected_files, 64)
-    print(len(input_tokens), len(label_tokens))
-    with open(data_folder + '/transformer_input_label/input_tokens.pkl', 'wb') as f:
-        pickle.dump(input_tokens, f)
-    with open(data_folder + '/transformer_input_label/label_tokens.pkl', 'wb') as f:
-        pickle.dump(label_tokens, f)
+    # Shards are what main.py trains from. Pairs go from the memory-mapped token shards to the pair shards
+    # one file at a time, so the pair list is never built.
+    shard_dir = data_folder + '/transformer_input_label/shards'
+    pairs = window_pairs(tqdm(collected_files, desc="Windows"), window_size, window_stride)
+    num_shards = write_pair_shards(pairs, shard_dir)
+    print("Wrote", num_shards, "pair shards")
+    # Packed rows also keep the file ends the pairs drop (main.py --packed)
+    num_packed = write_packed_shards(packed_rows(collected_files, window_size), shard_dir)
+    print("Wrote", num_packed, "packed shards")
     print("Successfully parsed ", len(midi_filepaths), " files")
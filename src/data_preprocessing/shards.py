@@ -0,0 +1,70 @@
+import os
+import glob
+import numpy as np
+
+# Read back by model/dataset.py
+SHARD_PATTERN = "pairs_{:05d}.npy"
+PACKED_PATTERN = "packed_{:05d}.npy"
+
+
+def write_pair_shards(pair_blocks, shard_dir, shard_size=8192):
+    """
+    Writes (input, label) window pairs as .npy shards of [num_pairs x 2 x window_size] uint16, which the
+    training pipeline memory-maps and streams. Pairs are consumed as they come, so at most one shard is
+    held in memory at a time.
+
+    :param pair_blocks: iterable of [num_pairs x 2 x window_size] arrays, e.g. preprocess.window_pairs
+    :param shard_dir: directory the shards are written to, created if needed
+    :param shard_size: number of pairs per shard
+    :return: number of shards written
+    """
+    return write_shards(pair_blocks, shard_dir, SHARD_PATTERN, shard_size)
+
+
+def write_packed_shards(row_blocks, shard_dir, shard_size=8192):
+    """
+    Writes packed rows as .npy shards of [num_rows x 3 x window_size] uint16, next to the pair shards. Read
+    back by model.dataset.read_packed.
+
+    :param row_blocks: iterable of [num_rows x 3 x window_size] arrays, e.g. packing.packed_rows
+    :return: number of shards written
+    """
+    return write_shards(row_blocks, shard_dir, PACKED_PATTERN, shard_size)
+
+
+def write_shards(blocks, shard_dir, pattern, shard_size):
+    '''
+    Writes blocks of equally shaped rows to shards named after pattern, replacing the shards a previous run
+    left there. Rows are copied straight into one reused shard buffer, so a shard is the most ever held in
+    memory. Ids are stored as uint16 (half of int32 on disk and in the page cache); the reader widens them.
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(shard_dir, pattern.replace('{:05d}', '*'))):
+        os.remove(path)
+    num_shards = 0
+    shard = None
+    filled = 0
+
+    def flush():
+        nonlocal num_shards, filled
+        np.save(os.path.join(shard_dir, pattern.format(num_shards)), shard[:filled])
+        num_shards += 1
+        filled = 0
+
+    for block in blocks:
+        block = np.asarray(block)
+        if block.dtype != np.uint16 and block.size and (block.min() < 0 or block.max() > np.iinfo(np.uint16).max):
+            raise ValueError("Ids do not fit in uint16")
+        if shard is None:
+            shard = np.empty([shard_size, *block.shape[1:]], dtype=np.uint16)
+        start = 0
+        while start < len(block):
+            count = min(len(block) - start, shard_size - filled)
+            shard[filled:filled + count] = block[start:start + count]
+            filled += count
+            start += count
+            if filled == shard_size:
+                flush()
+    if filled:
+        flush()
+    return num_shards
@@ -0,0 +1,96 @@
+import numpy as np
+
+# Token ids are looked up by kind ('Bar', 'Pitch', 'PitchDrum', ...) and pitch in the tokenizer vocab, whose
+# token names are '<kind>_<value>', rather than hard-coded: they move whenever the tokenizer config does.
+
+
+def kind_ids(vocab, kind):
+    '''Sorted ids of the tokens of one kind, e.g. 'Bar' or 'PitchDrum\''''
+    return np.array(sorted(index for name, index in vocab.items() if name.partition('_')[0] == kind), dtype=np.int64)
+
+
+def pitch_ids(vocab, low=None, high=None):
+    '''Sorted ids of the Pitch tokens with low <= pitch < high (MIDI pitches, either bound optional)'''
+    ids = []
+    for name, index in vocab.items():
+        kind, _, value = name.partition('_')
+        if kind == 'Pitch' and value.isdigit() and (low is None or int(value) >= low) and (high is None or int(value) < high):
+            ids.append(index)
+    return np.array(sorted(ids), dtype=np.int64)
+
+
+def id_lookup(ids, vocab):
+    '''Boolean table over the vocab, True at ids, so lookup[tokens] tells which tokens are among them'''
+    lookup = np.zeros(max(vocab.values()) + 1, dtype=bool)
+    lookup[ids] = True
+    return lookup
+
+
+def dedupe_bars(tokens, bar_ids):
+    """
+    Collapses runs of consecutive Bar tokens (empty bars) into one.
+
+    :param tokens: 1-D array of token ids
+    :param bar_ids: kind_ids(vocab, 'Bar')
+    :return: the tokens without the repeated Bar tokens
+    """
+    tokens = np.asarray(tokens)
+    is_bar = np.isin(tokens, bar_ids)
+    repeated = np.zeros(len(tokens), dtype=bool)
+    repeated[:-1] = is_bar[:-1] & (tokens[:-1] == tokens[1:])
+    return tokens[~repeated]
+
+
+def drop_notes(tokens, start_lookup, note_length=3):
+    """
+    Removes every note that starts with one of the tokens of start_lookup, i.e. that token and the
+    note_length - 1 after it (Pitch, Velocity, Duration). Like a scan from the left, tokens already removed
+    with an earlier note do not start a note of their own.
+
+    :param tokens: 1-D array of token ids
+    :param start_lookup: id_lookup of the tokens that start a note to remove, e.g. of pitch_ids
+    :return: the remaining tokens
+    """
+    tokens = np.asarray(tokens)
+    candidates = start_lookup[tokens]
+    # A candidate starts a note unless the note of one of the note_length - 1 before it covers it. Every pass
+    # settles one more candidate of each run of overlapping ones, so this takes a pass or two on real data.
+    starts = candidates
+    while True:
+        covered = np.zeros(len(tokens), dtype=bool)
+        for offset in range(1, note_length):
+            covered[offset:] |= starts[:-offset]
+        settled = candidates & ~covered
+        if np.array_equal(settled, starts):
+            break
+        starts = settled
+    removed = np.zeros(len(tokens) + note_length, dtype=np.int64)
+    for offset in range(note_length):
+        removed[offset:offset + len(tokens)] += starts
+    return tokens[removed[:len(tokens)] == 0]
+
+
+def windows_without(windows, reject_lookup):
+    """
+    :param windows: [num_windows x window_size] array of token ids
+    :param reject_lookup: id_lookup of the tokens a window must not contain, e.g. of kind_ids(vocab, 'PitchDrum')
+    :return: boolean mask of the windows that contain none of them
+    """
+    return ~reject_lookup[windows].any(axis=-1)
+
+
+def fit_melody(tokens, vocab, melody_length, start_token=1):
+    """
+    Melody input of the model from the token ids of a melody: repeated Bar tokens collapsed (dedupe_bars),
+    then repeated or truncated to fill the melody_length - 1 positions after the start token.
+
+    :param tokens: token ids of the melody, not empty
+    :param vocab: tokenizer vocab the ids come from
+    :param melody_length: melody length of the model, start token included
+    :return: list of melody_length token ids
+    """
+    tokens = dedupe_bars(tokens, kind_ids(vocab, 'Bar'))
+    if not len(tokens):
+        raise ValueError("Melody has no tokens")
+    repeats = -(-(melody_length - 1) // len(tokens))
+    return [start_token] + np.tile(tokens, repeats)[:melody_length - 1].tolist()
@@ -0,0 +1,102 @@
+import os
+import glob
+import shutil
+import numpy as np
+
+# Token ids of many files concatenated, with an index of where every file starts and the file names
+TOKENS_PATTERN = "tokens_{:05d}.npy"
+OFFSETS_PATTERN = "tokens_{:05d}.offsets.npy"
+NAMES_PATTERN = "tokens_{:05d}.names.txt"
+
+
+def write_token_shards(token_files, shard_dir, shard_tokens=2**24):
+    """
+    Writes tokenized files as shards of concatenated uint16 token ids (2 bytes per token), each with an
+    int64 offsets index (file i of the shard is tokens[offsets[i]:offsets[i + 1]]) and the file names.
+    Files are consumed as they come, so at most one shard is held in memory.
+
+    The shards are written to a staging directory and only replace the token shards already in shard_dir
+    once all of them are written, so token_files may read from the shards being replaced (TokenShards),
+    and an interrupted run leaves the old shards as they were.
+
+    :param token_files: iterable of (name, token ids) per file
+    :param shard_dir: directory the shards are written to, created if needed
+    :param shard_tokens: a shard is closed once it holds at least this many tokens
+    :return: number of shards written
+    """
+    staging_dir = os.path.join(shard_dir, '.staging')
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    num_shards = 0
+    names, files = [], []
+    num_tokens = 0
+
+    def flush():
+        nonlocal num_shards, names, files, num_tokens
+        offsets = np.zeros(len(files) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in files], out=offsets[1:])
+        tokens = np.concatenate(files) if files else np.zeros(0, dtype=np.uint16)
+        np.save(os.path.join(staging_dir, TOKENS_PATTERN.format(num_shards)), tokens)
+        np.save(os.path.join(staging_dir, OFFSETS_PATTERN.format(num_shards)), offsets)
+        with open(os.path.join(staging_dir, NAMES_PATTERN.format(num_shards)), 'w') as f:
+            f.writelines(name + '\n' for name in names)
+        num_shards += 1
+        names, files, num_tokens = [], [], 0
+
+    for name, ids in token_files:
+        ids = np.asarray(ids)
+        if ids.size and (ids.min() < 0 or ids.max() > np.iinfo(np.uint16).max):
+            raise ValueError(f"Token ids of '{name}' do not fit in uint16")
+        names.append(name)
+        files.append(ids.astype(np.uint16))
+        num_tokens += len(ids)
+        if num_tokens >= shard_tokens:
+            flush()
+    if files:
+        flush()
+    # Shards being read from stay readable when removed here, as they are memory-mapped
+    for path in glob.glob(os.path.join(shard_dir, 'tokens_*')):
+        os.remove(path)
+    for path in glob.glob(os.path.join(staging_dir, 'tokens_*')):
+        os.replace(path, os.path.join(shard_dir, os.path.basename(path)))
+    os.rmdir(staging_dir)
+    return num_shards
+
+
+class TokenShards:
+    """
+    Read-only view of the token shards in a directory. The token arrays are memory-mapped, so opening a
+    corpus only reads the (small) offsets and names, and a file's tokens are paged in when it is used.
+    Indexing gives the uint16 token ids of one file, in the order they were written.
+    """
+
+    def __init__(self, shard_dir):
+        token_paths = sorted(glob.glob(os.path.join(shard_dir, 'tokens_*[0-9].npy')))
+        self.tokens = [np.load(path, mmap_mode='r') for path in token_paths]
+        self.offsets = [np.load(path[:-len('.npy')] + '.offsets.npy') for path in token_paths]
+        self.names = []
+        for path in token_paths:
+            with open(path[:-len('.npy')] + '.names.txt') as f:
+                self.names += f.read().splitlines()
+        # Index of the first file of every shard, and one past the last file
+        self.first_file = np.cumsum([0] + [len(offsets) - 1 for offsets in self.offsets])
+
+    def __len__(self):
+        return int(self.first_file[-1])
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        index %= len(self)
+        shard = int(np.searchsorted(self.first_file, index, side='right')) - 1
+        offsets = self.offsets[shard]
+        local = index - self.first_file[shard]
+        return self.tokens[shard][offsets[local]:offsets[local + 1]]
+
+    def __iter__(self):
+        for tokens, offsets in zip(self.tokens, self.offsets):
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                yield tokens[start:end]
+
+    def num_tokens(self):
+        return sum(len(tokens) for tokens in self.tokens)
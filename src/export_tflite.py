@@ -0,0 +1,118 @@
+import numpy as np
+import tensorflow as tf
+
+from model.model import AccompanimentModel, accuracy_function, loss_function
+from model.decoder import TransformerDecoder
+from model.dataset import shard_paths, read_pairs, split_pairs, batch_pairs
+from inference.tflite_runtime import TFLiteDecoder
+
+import os
+import argparse
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Export a trained model to a quantized TFLite model for CPU inference.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chkpt_path',         default='src/saved_models/model_duet.keras',    help='Trained model to export')
+    parser.add_argument('--output_path',        default='src/saved_models/model_duet.tflite',   help='Where the TFLite model is written')
+    parser.add_argument('--quantization',       default='dynamic', choices=['none', 'dynamic', 'int8'], help='Dynamic-range (int8 weights) or int8 (weights and matmul activations, attention softmax in float)')
+    parser.add_argument('--shard_dir',          default='src/data_preprocessing/transformer_input_label/shards', help='Pair shards written by preprocess.py')
+    parser.add_argument('--num_representative', type=int, default=200, help='Pairs used to calibrate int8 activations')
+    parser.add_argument('--num_eval',           type=int, default=500, help='Held-out pairs (as in main.py) used to compare accuracy and perplexity, 0 to skip')
+    parser.add_argument('--batch_size',         type=int, default=50,  help='Batch size of the Keras evaluation')
+    if args is None:
+        return parser.parse_args()
+    return parser.parse_args(args)
+
+
+def export_function(decoder):
+    '''Full-window forward pass with fixed single-example shapes, which is what the converter needs'''
+    melody_length = decoder.image_embedding.kernel.shape[0]
+
+    @tf.function(input_signature=[
+        tf.TensorSpec([1, melody_length], tf.int32, name='melody'),
+        tf.TensorSpec([1, decoder.window_size], tf.int32, name='harmony'),
+    ])
+    def serve(melody, harmony):
+        return decoder(melody, harmony)
+
+    return serve.get_concrete_function()
+
+
+def convert(decoder, quantization, representative_pairs):
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([export_function(decoder)], decoder)
+    if quantization in ('dynamic', 'int8'):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        # Calibration runs once per conversion, and the debugger below converts more than once
+        representative_pairs = list(representative_pairs)
+
+        def representative_dataset():
+            for melody, harmony in representative_pairs:
+                yield [np.asarray([melody], dtype=np.int32), np.asarray([harmony], dtype=np.int32)]
+        converter.representative_dataset = representative_dataset
+        # Token ids stay int32 at the boundary; ops without an int8 kernel fall back to float
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+        # The attention masks (-1e9 where hidden) would set the int8 scale of the attention scores and round
+        # every visible score to the same value, so the mask adds, the scaling and the softmax stay in float.
+        # The matmuls and dense layers, where the time goes, are still int8.
+        debugger = tf.lite.experimental.QuantizationDebugger(
+            converter       = converter,
+            debug_dataset   = representative_dataset,
+            debug_options   = tf.lite.experimental.QuantizationDebugOptions(denylisted_ops=['ADD', 'MUL', 'SOFTMAX']),
+        )
+        return debugger.get_nondebug_quantized_model()
+    return converter.convert()
+
+
+def test_tflite(decoder, test_pairs, padding_index):
+    '''Same metrics as AccompanimentModel.test, computed from TFLite logits over (captions, image_features) pairs'''
+    total_loss = total_seen = total_correct = 0
+    for captions, melody in test_pairs:
+        decoder_input = captions[np.newaxis, :-1]
+        decoder_labels = captions[np.newaxis, 1:]
+        probs = tf.constant(decoder(melody[np.newaxis], decoder_input))
+        mask = decoder_labels != padding_index
+        num_predictions = tf.reduce_sum(tf.cast(mask, tf.float32))
+        total_loss += loss_function(probs, decoder_labels, mask)
+        total_seen += num_predictions
+        total_correct += num_predictions * accuracy_function(probs, decoder_labels, mask)
+    avg_loss = float(total_loss / total_seen)
+    return np.exp(avg_loss), float(total_correct / total_seen)
+
+
+def main(args):
+    model = tf.keras.models.load_model(
+        args.chkpt_path,
+        custom_objects=dict(
+            TransformerDecoder  = TransformerDecoder,
+            AccompanimentModel  = AccompanimentModel,
+        ),
+    )
+    # Pairs are streamed from the shards, so only the ones used here are read
+    pairs = read_pairs(shard_paths(args.shard_dir))
+
+    # The model is conditioned on the label window and predicts the input window, as in main.py
+    representative_pairs = (
+        (label_tokens, input_tokens[:-1]) for input_tokens, label_tokens in pairs.take(args.num_representative).as_numpy_iterator()
+    )
+    tflite_model = convert(model.decoder, args.quantization, representative_pairs)
+    with open(args.output_path, 'wb') as f:
+        f.write(tflite_model)
+    keras_bytes = sum(np.prod(w.shape) * w.dtype.size for w in model.weights)
+    print(f"TFLite model saved to {args.output_path}: {os.path.getsize(args.output_path) / 2**20:.1f} MB "
+          f"(float32 weights: {keras_bytes / 2**20:.1f} MB)")
+
+    if args.num_eval:
+        test_pairs = split_pairs(pairs)[1].take(args.num_eval)
+        model.compile(optimizer=None, loss=loss_function, metrics=[accuracy_function])
+        # Every pair, last partial batch included, so both models are evaluated on the same pairs
+        test_data = batch_pairs(test_pairs, args.batch_size, drop_remainder=False)
+        keras_perp, keras_acc = model.test(test_data, 0)
+        tflite_perp, tflite_acc = test_tflite(TFLiteDecoder(args.output_path), test_pairs.as_numpy_iterator(), 0)
+        print(f"Keras:  perplexity {keras_perp:.3f}, accuracy {keras_acc:.4f}")
+        print(f"TFLite: perplexity {tflite_perp:.3f}, accuracy {tflite_acc:.4f}")
+        print(f"Drift:  perplexity {tflite_perp - keras_perp:+.3f}, accuracy {tflite_acc - keras_acc:+.4f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,63 @@
+import tensorflow as tf
+import pickle
+import symusic
+
+from model.model import AccompanimentModel
+from model.decoder import TransformerDecoder, fuse_attention
+from inference.context_cache import ContextCache
+from inference.streaming import harmonize_stream
+
+import argparse
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Harmonize a full-length melody MIDI in one streaming pass.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--midi_path',      required=True,                          help='Melody to harmonize')
+    parser.add_argument('--output_path',    default='src/testing/test_outputs/harmonized.mid', help='Where the combined MIDI is written')
+    parser.add_argument('--chkpt_path',     default='src/saved_models/model_duet.keras',      help='Model to generate with')
+    parser.add_argument('--tokenizer_path', default='src/data_preprocessing/tokenizers/tokenizer.pkl', help='Pickled tokenizer')
+    parser.add_argument('--fused_attention', action='store_true',    help='Convert the model to the fused multi-head attention layer')
+    parser.add_argument('--precision',      default='float32', choices=['float32', 'mixed_bfloat16'], help='Keras dtype policy to run the model in')
+    parser.add_argument('--hop_beats',      type=int,   default=8,      help='Beats of new harmony per chunk')
+    parser.add_argument('--overlap_beats',  type=int,   default=8,      help='Beats of melody each chunk looks back')
+    parser.add_argument('--carry_tokens',   type=int,   default=16,     help='Harmony tokens carried into the next chunk')
+    parser.add_argument('--temperature',    type=float, default=1.0,    help='Sampling temperature')
+    parser.add_argument('--top_k',          type=int,   default=0,      help='Sample from the k most likely tokens only, 0 to disable')
+    parser.add_argument('--top_p',          type=float, default=1.0,    help='Nucleus sampling mass, 1.0 to disable')
+    parser.add_argument('--seed',           type=int,   default=None,   help='RNG seed')
+    if args is None:
+        return parser.parse_args()
+    return parser.parse_args(args)
+
+
+def main(args):
+    with open(args.tokenizer_path, 'rb') as f:
+        tokenizer = pickle.load(f)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    model = tf.keras.models.load_model(
+        args.chkpt_path,
+        custom_objects=dict(
+            TransformerDecoder  = TransformerDecoder,
+            AccompanimentModel  = AccompanimentModel,
+        ),
+    )
+    if args.fused_attention:
+        model.decoder = fuse_attention(model.decoder)
+    score = symusic.Score(args.midi_path)
+    harmonized = harmonize_stream(
+        model.decoder, tokenizer, score,
+        hop_beats       = args.hop_beats,
+        overlap_beats   = args.overlap_beats,
+        carry_tokens    = args.carry_tokens,
+        temperature     = args.temperature,
+        seed            = args.seed,
+        top_k           = args.top_k,
+        top_p           = args.top_p,
+        context_cache   = ContextCache(model.decoder),
+    )
+    harmonized.dump_midi(args.output_path)
+    print(f"Harmonized MIDI saved as '{args.output_path}'")
+
+
+if __name__ == '__main__':
+    main(parse_args())
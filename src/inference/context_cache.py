@@ -0,0 +1,76 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+
+class ContextCache:
+    """
+    LRU cache of TransformerDecoder.encode_context outputs (the embedded melody and its projected context
+    attention keys/values), keyed by a hash of the melody token ids. Repeated samples, temperature sweeps and
+    re-requests of the same melody then skip the melody embedding and context projections entirely.
+
+    The cache belongs to one decoder: its weights are not part of the key.
+    """
+
+    def __init__(self, decoder, max_bytes=256 * 2**20):
+        self.decoder = decoder
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def melody_key(melody):
+        return hashlib.sha1(np.ascontiguousarray(melody, dtype=np.int64).tobytes()).hexdigest()
+
+    def encode_context(self, melodies):
+        """
+        Drop-in replacement for decoder.encode_context. Melodies that are not cached yet are encoded together
+        in one call, duplicates within the batch only once.
+
+        :param melodies: melody token ids [BATCH_SIZE x MELODY_LENGTH]
+        :return: same structure as decoder.encode_context, batched in the order of melodies
+        """
+        melodies = np.asarray(melodies)
+        keys = [self.melody_key(melody) for melody in melodies]
+
+        missing = {}
+        for row, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif key in missing:
+                self.hits += 1
+            else:
+                missing[key] = row
+                self.misses += 1
+
+        rows = {key: self.entries[key] for key in keys if key in self.entries}
+        if missing:
+            encoded = self.decoder.encode_context(melodies[list(missing.values())])
+            for i, key in enumerate(missing):
+                rows[key] = tf.nest.map_structure(lambda t: t[i:i+1], encoded)
+                self.insert(key, rows[key])
+
+        return tf.nest.map_structure(lambda *ts: tf.concat(ts, axis=0), *[rows[key] for key in keys])
+
+    def insert(self, key, context):
+        size = sum(t.shape.num_elements() * t.dtype.size for t in tf.nest.flatten(context))
+        if size > self.max_bytes:
+            return
+        self.entries[key] = context
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= sum(t.shape.num_elements() * t.dtype.size for t in tf.nest.flatten(evicted))
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes":   self.nbytes,
+            "hits":    self.hits,
+            "misses":  self.misses,
+        }
@@ -0,0 +1,124 @@
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+from inference.sampling import sample_logits
+
+# One compiled decode/sampling step per decoder, shared by every generate call
+_decode_steps = weakref.WeakKeyDictionary()
+_sampling_steps = weakref.WeakKeyDictionary()
+
+
+def get_decode_step(decoder):
+    '''decoder.decode_step compiled once per decoder, for any number of new positions'''
+    if decoder not in _decode_steps:
+        _decode_steps[decoder] = tf.function(decoder.decode_step, reduce_retracing=True)
+    return _decode_steps[decoder]
+
+
+def get_sampling_step(decoder):
+    """
+    Compiles decode_step and sampling into one graph, so only the sampled ids ever leave the device.
+    Shapes of the cache and the batch vary from step to step, reduce_retracing keeps that to a single trace.
+    """
+    if decoder not in _sampling_steps:
+        @tf.function(reduce_retracing=True)
+        def sampling_step(context, tokens, position, cache, temperatures, seeds, top_k, top_p, banned_mask):
+            logits, cache = decoder.decode_step(context, tokens[:, tf.newaxis], position, cache)
+            step_seeds = tf.stack([seeds, tf.fill(tf.shape(seeds), tf.cast(position, tf.int64))], axis=-1)
+            return sample_logits(logits[:, -1], temperatures, step_seeds, top_k, top_p, banned_mask), cache
+        _sampling_steps[decoder] = sampling_step
+    return _sampling_steps[decoder]
+
+
+def check_length(window_size, length):
+    '''Raises a ValueError if sequences of length tokens do not fit a harmony window of window_size'''
+    # The last token fed to the decoder sits at position length - 2, which has to be inside the window
+    if length > window_size + 1:
+        raise ValueError(f"Cannot generate {length} tokens with a window of {window_size}, at most {window_size + 1}")
+
+
+def generate_stream(decoder, melodies, temperatures, seeds, length, start_token=1, end_token=None, banned_tokens=(0,),
+                    context_cache=None, top_k=0, top_p=1.0, prefixes=None):
+    """
+    Generates harmonies for a whole batch of melodies at once. Every step runs a single compiled
+    decode-and-sample step for all sequences that are still going; a sequence drops out of the batch as
+    soon as it samples end_token.
+
+    :param decoder: TransformerDecoder (e.g. AccompanimentModel.decoder)
+    :param melodies: melody token ids [BATCH_SIZE x MELODY_LENGTH]
+    :param temperatures: one temperature per melody (or a single one for all)
+    :param seeds: one integer seed per melody (None entries are drawn at random), None for all random
+    :param length: maximum length of a generated sequence, start token included, at most decoder.window_size + 1
+    :param start_token: id every harmony starts with
+    :param end_token: id that finishes a sequence early, None to always generate length tokens
+    :param banned_tokens: ids that are never sampled (by default the padding/unk id)
+    :param context_cache: optional ContextCache to reuse the encoded melody across calls
+    :param top_k: only sample from the k most likely tokens, 0 to disable
+    :param top_p: only sample from the smallest set of tokens with probability mass top_p, 1.0 to disable
+    :param prefixes: tokens every sequence starts with instead of start_token [BATCH_SIZE x PREFIX_LENGTH],
+                     all prefilled into the cache with one decode_step
+    :return: generator of (rows, tokens) per step, where rows are the indices into melodies that are still
+             active and tokens the ids just sampled for them
+    """
+    check_length(decoder.window_size, length)
+    melodies = np.asarray(melodies)
+    batch_size = len(melodies)
+    if seeds is None:
+        seeds = [None] * batch_size
+    seeds = [np.random.randint(2**31) if seed is None else seed for seed in seeds]
+
+    sampling_step = get_sampling_step(decoder)
+    temperatures = tf.constant(np.broadcast_to(np.asarray(temperatures, dtype=np.float32), [batch_size]))
+    seeds = tf.constant(seeds, dtype=tf.int64)
+    top_k = tf.constant(top_k, dtype=tf.int32)
+    top_p = tf.constant(top_p, dtype=tf.float32)
+    banned_mask = np.zeros([decoder.vocab_size], dtype=bool)
+    banned_mask[list(banned_tokens)] = True
+    banned_mask = tf.constant(banned_mask)
+
+    if prefixes is None:
+        prefixes = np.full([batch_size, 1], start_token)
+    prefixes = np.asarray(prefixes)
+
+    rows = np.arange(batch_size)
+    context = (context_cache or decoder).encode_context(melodies)
+    cache = decoder.init_cache(batch_size)
+    if prefixes.shape[1] > 1:
+        _, cache = get_decode_step(decoder)(context, prefixes[:, :-1], tf.constant(0), cache)
+    tokens = tf.constant(prefixes[:, -1], dtype=tf.int64)
+    for position in range(prefixes.shape[1] - 1, length - 1):
+        tokens, cache = sampling_step(context, tokens, tf.constant(position), cache, temperatures, seeds, top_k, top_p, banned_mask)
+        sampled = tokens.numpy()
+        yield rows, sampled
+
+        if end_token is not None:
+            keep = np.flatnonzero(sampled != end_token)
+            if len(keep) < len(rows):
+                if len(keep) == 0:
+                    return
+                rows = rows[keep]
+                tokens, temperatures, seeds = (tf.gather(t, keep) for t in (tokens, temperatures, seeds))
+                context = tf.nest.map_structure(lambda t: tf.gather(t, keep), context)
+                cache = tf.nest.map_structure(lambda t: tf.gather(t, keep), cache)
+
+
+def generate(decoder, melodies, temperatures, seeds, length, start_token=1, end_token=None, banned_tokens=(0,),
+             context_cache=None, top_k=0, top_p=1.0, prefixes=None):
+    """
+    Same as generate_stream, but collects the finished sequences.
+
+    :return: list with one list of token ids per melody, starting with start_token (or its prefix)
+    """
+    check_length(decoder.window_size, length)
+    if prefixes is None:
+        outputs = [[start_token] for _ in range(len(melodies))]
+    else:
+        outputs = [[int(token) for token in prefix] for prefix in prefixes]
+    steps = generate_stream(decoder, melodies, temperatures, seeds, length, start_token, end_token, banned_tokens,
+                            context_cache, top_k, top_p, prefixes)
+    for rows, tokens in steps:
+        for row, token in zip(rows, tokens):
+            outputs[row].append(int(token))
+    return outputs
@@ -0,0 +1,39 @@
+import symusic
+
+
+def merge_scores(melody, harmony, melody_name="Melody", harmony_name="Harmony"):
+    """
+    Combines two scores into one in memory, melody tracks first, each side renamed. The harmony is
+    resampled to the melody's resolution if they differ.
+
+    :return: new symusic Score
+    """
+    combined = melody.copy()
+    if harmony.ticks_per_quarter != combined.ticks_per_quarter:
+        harmony = harmony.resample(combined.ticks_per_quarter, min_dur=1)
+    for track in combined.tracks:
+        track.name = melody_name
+    for track in harmony.tracks:
+        track = track.copy()
+        track.name = harmony_name
+        combined.tracks.append(track)
+    return combined
+
+
+def render_duet(tokenizer, melody_ids, harmony_ids):
+    '''Decodes melody and harmony token ids and merges them into one two-part Score, no temporary files'''
+    return merge_scores(tokenizer.decode([melody_ids]), tokenizer.decode([harmony_ids]))
+
+
+def append_chunk(track, chunk, offset, span, begin=0):
+    """
+    Appends the notes of a decoded chunk that start within [begin, begin + span) to track, shifted by offset.
+    Used to stitch chunk-wise renderings into a single track.
+
+    :param chunk: symusic Score already at the resolution of track
+    :param offset: time of the chunk's 0 in track
+    """
+    for chunk_track in chunk.tracks:
+        for note in chunk_track.notes:
+            if begin <= note.time < begin + span:
+                track.notes.append(symusic.Note(note.time + offset, note.duration, note.pitch, note.velocity))
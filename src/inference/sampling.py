@@ -0,0 +1,48 @@
+import tensorflow as tf
+
+
+def filter_logits(logits, top_k, top_p, banned_mask):
+    """
+    Masks out everything that may not be sampled by setting it to -inf.
+
+    :param logits: [BATCH_SIZE x VOCAB_SIZE], already divided by the temperature
+    :param top_k: keep only the k most likely tokens, 0 to disable
+    :param top_p: keep the smallest set of tokens whose probability mass reaches top_p, 1.0 to disable
+    :param banned_mask: bool [VOCAB_SIZE], True for ids that are never sampled
+    :return: filtered logits [BATCH_SIZE x VOCAB_SIZE]
+    """
+    vocab_size = tf.shape(logits)[-1]
+    logits = tf.where(banned_mask[tf.newaxis], tf.constant(-float('inf'), logits.dtype), logits)
+
+    # top-k: everything below the k-th largest logit goes
+    k = tf.where(top_k > 0, tf.minimum(top_k, vocab_size), vocab_size)
+    kth_largest = tf.math.top_k(logits, k=k).values[:, -1:]
+    logits = tf.where(logits < kth_largest, tf.constant(-float('inf'), logits.dtype), logits)
+
+    # top-p: keep a sorted token while the mass before it is still below top_p, so the most likely always stays
+    sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+    mass_before = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1, exclusive=True)
+    kept = tf.where(mass_before < top_p, sorted_logits, tf.constant(float('inf'), logits.dtype))
+    smallest_kept = tf.reduce_min(kept, axis=-1, keepdims=True)
+    return tf.where(logits < smallest_kept, tf.constant(-float('inf'), logits.dtype), logits)
+
+
+def sample_logits(logits, temperatures, seeds, top_k, top_p, banned_mask):
+    """
+    Draws one token per row with the Gumbel-max trick. Each row's noise only depends on its own seed pair,
+    so a sequence samples the same tokens no matter which batch it is decoded in.
+
+    :param logits: [BATCH_SIZE x VOCAB_SIZE]
+    :param temperatures: [BATCH_SIZE]
+    :param seeds: int64 [BATCH_SIZE x 2] stateless seeds, e.g. (sequence seed, position)
+    :return: int64 sampled ids [BATCH_SIZE]
+    """
+    logits = tf.cast(logits, tf.float32) / temperatures[:, tf.newaxis]
+    logits = filter_logits(logits, top_k, top_p, banned_mask)
+    vocab_size = tf.shape(logits)[-1]
+    uniform = tf.map_fn(
+        lambda seed: tf.random.stateless_uniform([vocab_size], seed, minval=1e-20, maxval=1.0),
+        seeds, fn_output_signature=tf.float32,
+    )
+    gumbel = -tf.math.log(-tf.math.log(uniform))
+    return tf.argmax(logits + gumbel, axis=-1)
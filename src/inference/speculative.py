@@ -0,0 +1,98 @@
+import numpy as np
+import tensorflow as tf
+
+from inference.generation import get_decode_step, check_length
+
+
+def truncate_cache(cache, length):
+    '''Drops every cached position from length on; all caches keep time on axis 1'''
+    return tf.nest.map_structure(lambda t: t[:, :length], cache)
+
+
+def token_probs(logits, temperature, banned_tokens):
+    '''Host-side sampling distribution(s), matching what inference.sampling draws from without top-k/top-p'''
+    logits = np.asarray(logits, dtype=np.float64) / temperature
+    logits[..., list(banned_tokens)] = -np.inf
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return probs / probs.sum(axis=-1, keepdims=True)
+
+
+def speculative_generate(decoder, draft_decoder, melody, temperature, length, num_draft=4, seed=None,
+                         start_token=1, end_token=None, banned_tokens=(0,)):
+    """
+    Speculative sampling for a single melody: the small draft decoder proposes num_draft tokens one by one,
+    then the full decoder scores all of them in one decode_step. Proposals are accepted with probability
+    min(1, p/q) and the first rejected one is resampled from max(0, p - q), so the output follows exactly the
+    distribution of sampling from decoder alone.
+
+    :param decoder: the TransformerDecoder whose distribution is sampled
+    :param draft_decoder: a smaller TransformerDecoder over the same vocabulary and melody input
+    :param melody: melody token ids [MELODY_LENGTH]
+    :param temperature: sampling temperature, applied to both models
+    :param length: maximum length of the generated sequence, start token included, at most window_size + 1 of both decoders
+    :param num_draft: tokens proposed per verification pass
+    :param seed: RNG seed
+    :return: (token ids starting with start_token, {"proposed": ..., "accepted": ...})
+    """
+    check_length(min(decoder.window_size, draft_decoder.window_size), length)
+    rng = np.random.default_rng(seed)
+    decode_step = get_decode_step(decoder)
+    draft_step = get_decode_step(draft_decoder)
+    melody = np.asarray(melody)[np.newaxis]
+    context, draft_context = decoder.encode_context(melody), draft_decoder.encode_context(melody)
+    cache, draft_cache = decoder.init_cache(1), draft_decoder.init_cache(1)
+    cached = draft_cached = 0   # number of tokens each cache holds
+    tokens = [start_token]
+    stats = {"proposed": 0, "accepted": 0}
+
+    while len(tokens) < length and (end_token is None or tokens[-1] != end_token):
+        # The token sampled last is never fed, so proposals stop one short of length (the verify pass adds one)
+        num_proposals = min(num_draft, length - len(tokens) - 1)
+
+        # Draft: catch up on tokens it has not seen, then propose one token at a time
+        proposals, draft_probs = [], []
+        pending = tokens[draft_cached:]
+        for _ in range(num_proposals):
+            logits, draft_cache = draft_step(draft_context, np.array([pending]), tf.constant(draft_cached), draft_cache)
+            draft_cached += len(pending)
+            q = token_probs(logits[0, -1], temperature, banned_tokens)
+            pending = [int(rng.choice(len(q), p=q))]
+            proposals += pending
+            draft_probs.append(q)
+
+        # Target: one pass over the unseen tokens plus every proposal, giving num_proposals + 1 distributions
+        verify = tokens[cached:] + proposals
+        logits, cache = decode_step(context, np.array([verify]), tf.constant(cached), cache)
+        target_probs = token_probs(logits[0, len(verify) - num_proposals - 1:], temperature, banned_tokens)
+        previous_length = len(tokens)
+
+        accepted = 0
+        for proposal, p, q in zip(proposals, target_probs, draft_probs):
+            if rng.random() * q[proposal] < p[proposal]:
+                tokens.append(proposal)
+                accepted += 1
+                if proposal == end_token:
+                    break
+            else:
+                residual = np.maximum(p - q, 0)
+                # p <= q everywhere only happens by rounding (p == q in exact arithmetic): sample from p then
+                residual = residual / residual.sum() if residual.sum() > 0 else p
+                tokens.append(int(rng.choice(len(residual), p=residual)))
+                break
+        else:
+            # Every proposal accepted: the last target distribution gives one extra token for free
+            p = target_probs[-1]
+            tokens.append(int(rng.choice(len(p), p=p)))
+        stats["proposed"] += num_proposals
+        stats["accepted"] += accepted
+
+        # Only the accepted prefix is valid input for the next round, everything after it is rolled back
+        cached = previous_length + accepted
+        cache = truncate_cache(cache, cached)
+        draft_cached = min(draft_cached, cached)
+        draft_cache = truncate_cache(draft_cache, draft_cached)
+
+    tokens = tokens[:length]
+    if end_token is not None and end_token in tokens:
+        tokens = tokens[:tokens.index(end_token) + 1]
+    return tokens, stats
@@ -0,0 +1,133 @@
+import math
+import queue
+import threading
+
+import numpy as np
+import symusic
+
+from data_preprocessing.token_filters import fit_melody
+from inference.generation import generate
+from inference.rendering import append_chunk
+
+
+class _Stage(threading.Thread):
+    '''Pipeline thread that keeps its exception for the caller instead of dying silently'''
+
+    def __init__(self, target):
+        super().__init__(daemon=True)
+        self.target = target
+        self.error = None
+
+    def run(self):
+        try:
+            self.target()
+        except Exception as e:
+            self.error = e
+
+    def join_and_raise(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def harmonize_stream(decoder, tokenizer, score, hop_beats=8, overlap_beats=8, carry_tokens=16, temperature=1.0,
+                     seed=None, top_k=0, top_p=1.0, context_cache=None, max_pending=2):
+    """
+    Harmonizes a melody of any length by walking it in overlapping chunks. Chunk k owns the span
+    [k * hop_beats, (k + 1) * hop_beats); its melody context also looks overlap_beats back, and its harmony
+    starts from the last carry_tokens harmony tokens of chunk k - 1 so the accompaniment continues across the
+    boundary. The harmony of a chunk is timed like its melody context, so only the part of it in the chunk's
+    own span is kept. Tokenizing the next chunk and rendering the previous one run on their own threads while the
+    model decodes, with at most max_pending chunks queued between stages, so memory stays bounded.
+
+    :param decoder: TransformerDecoder
+    :param tokenizer: the tokenizer the model was trained with
+    :param score: melody as a symusic Score
+    :return: symusic Score with the melody tracks plus one harmony track
+    """
+    melody_length = decoder.image_embedding.kernel.shape[0]
+    length = decoder.window_size + 1
+    carry_tokens = min(carry_tokens, length - 2)
+    tpq = score.ticks_per_quarter
+    hop, overlap = hop_beats * tpq, overlap_beats * tpq
+    num_chunks = max(1, math.ceil(score.end() / hop))
+    base_seed = np.random.randint(2**31) if seed is None else seed
+
+    output = score.copy()
+    harmony_track = symusic.Track("Harmony", 0, False)
+    melodies = queue.Queue(maxsize=max_pending)
+    harmonies = queue.Queue(maxsize=max_pending)
+
+    # Set when decoding stops early, so the tokenizer stops too
+    stop = threading.Event()
+
+    def chunk_start(k):
+        return max(0, k * hop - overlap)
+
+    def tokenize_chunks():
+        try:
+            for k in range(num_chunks):
+                if stop.is_set():
+                    break
+                start = chunk_start(k)
+                chunk = score.clip(start, (k + 1) * hop).shift_time(-start)
+                if chunk.note_num():
+                    melodies.put(fit_melody(tokenizer(chunk)[0].ids, tokenizer.vocab, melody_length))
+                else:
+                    # A silent chunk is all padding after the start token
+                    melodies.put([1] + [tokenizer.pad_token_id] * (melody_length - 1))
+        finally:
+            melodies.put(None)
+
+    def render_chunks():
+        k = 0
+        try:
+            while (harmony_ids := harmonies.get()) is not None:
+                chunk = tokenizer.decode([harmony_ids]).resample(tpq, min_dur=1)
+                start = chunk_start(k)
+                append_chunk(harmony_track, chunk, start, hop, begin=k * hop - start)
+                k += 1
+        except Exception:
+            # Keep draining so the decoding loop never blocks on a full queue
+            while harmonies.get() is not None:
+                pass
+            raise
+
+    tokenizer_stage = _Stage(tokenize_chunks)
+    renderer_stage = _Stage(render_chunks)
+    tokenizer_stage.start()
+    renderer_stage.start()
+    carried = []
+    k = 0
+    finished = False
+    try:
+        while (melody := melodies.get()) is not None:
+            output_ids = generate(
+                decoder,
+                melodies      = np.array([melody]),
+                temperatures  = temperature,
+                seeds         = [base_seed + k],
+                length        = length,
+                top_k         = top_k,
+                top_p         = top_p,
+                context_cache = context_cache,
+                prefixes      = np.array([[1] + carried]),
+            )[0]
+            new_ids = output_ids[1 + len(carried):]
+            harmonies.put(new_ids)
+            carried = (carried + new_ids)[-carry_tokens:] if carry_tokens else []
+            k += 1
+        finished = True
+    finally:
+        # If decoding raised, the tokenizer may be waiting on a full queue: stop it and drain up to its None
+        stop.set()
+        if not finished:
+            while melodies.get() is not None:
+                pass
+        harmonies.put(None)
+    tokenizer_stage.join_and_raise()
+    renderer_stage.join_and_raise()
+
+    harmony_track.sort()
+    output.tracks.append(harmony_track)
+    return output
@@ -0,0 +1,72 @@
+import numpy as np
+import tensorflow as tf
+
+from inference.generation import check_length
+from inference.sampling import sample_logits
+
+
+class TFLiteDecoder:
+    """
+    Runs a decoder exported by export_tflite.py. The export has fixed shapes: one melody of the model's
+    melody length and one full harmony window per call, so generation recomputes the window every token
+    (there is no KV cache in the exported graph); the int8 kernels and smaller weights are what make it cheap.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        inputs = {detail['name']: detail for detail in self.interpreter.get_input_details()}
+        self.melody_input = next(detail for name, detail in inputs.items() if 'melody' in name)
+        self.harmony_input = next(detail for name, detail in inputs.items() if 'harmony' in name)
+        self.logits_output = self.interpreter.get_output_details()[0]
+        self.melody_length = self.melody_input['shape'][1]
+        self.window_size = self.harmony_input['shape'][1]
+        self.vocab_size = self.logits_output['shape'][-1]
+
+    def __call__(self, melodies, captions):
+        """
+        :param melodies: melody token ids [BATCH_SIZE x melody_length]
+        :param captions: harmony token ids [BATCH_SIZE x window_size]
+        :return: logits [BATCH_SIZE x window_size x vocab_size] as a numpy array
+        """
+        logits = []
+        for melody, caption in zip(melodies, captions):
+            self.interpreter.set_tensor(self.melody_input['index'], np.asarray([melody], dtype=np.int32))
+            self.interpreter.set_tensor(self.harmony_input['index'], np.asarray([caption], dtype=np.int32))
+            self.interpreter.invoke()
+            logits.append(self.interpreter.get_tensor(self.logits_output['index'])[0])
+        return np.stack(logits)
+
+
+def generate_tflite(decoder, melodies, temperatures, seeds, length, start_token=1, end_token=None, banned_tokens=(0,),
+                    top_k=0, top_p=1.0, pad_token=0):
+    """
+    inference.generation.generate for a TFLiteDecoder, with the same sampling and seeding, so the two paths
+    can be compared token for token.
+
+    :return: list with one list of token ids per melody, starting with start_token
+    """
+    check_length(decoder.window_size, length)
+    batch_size = len(melodies)
+    if seeds is None:
+        seeds = [None] * batch_size
+    seeds = np.array([np.random.randint(2**31) if seed is None else seed for seed in seeds], dtype=np.int64)
+    temperatures = np.broadcast_to(np.asarray(temperatures, dtype=np.float32), [batch_size])
+    banned_mask = np.zeros([decoder.vocab_size], dtype=bool)
+    banned_mask[list(banned_tokens)] = True
+
+    outputs = [[start_token] for _ in range(batch_size)]
+    active = list(range(batch_size))
+    for position in range(length - 1):
+        captions = np.full([len(active), decoder.window_size], pad_token)
+        for i, row in enumerate(active):
+            captions[i, :position + 1] = outputs[row]
+        logits = decoder(np.asarray(melodies)[active], captions)[:, position]
+        step_seeds = np.stack([seeds[active], np.full(len(active), position)], axis=-1)
+        tokens = sample_logits(logits, temperatures[active], step_seeds, top_k, top_p, banned_mask).numpy()
+        for row, token in zip(active, tokens):
+            outputs[row].append(int(token))
+        active = [row for row, token in zip(active, tokens) if token != end_token]
+        if not active:
+            break
+    return outputs
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Run main.py as several data-parallel workers on this host. Arguments not listed here are passed on to main.py.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num_workers',    type=int,   default=2,      help='Number of worker processes')
+    parser.add_argument('--devices',        default='cpu', choices=['cpu', 'gpu'], help='Run every worker on the CPU, or worker i on GPU i')
+    parser.add_argument('--host',           default='localhost',        help='Address the workers talk to each other on')
+    return parser.parse_known_args(args)
+
+
+def free_ports(num_ports):
+    '''Ports the OS reports as free; the workers bind them right after, so a collision is unlikely'''
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def worker_env(cluster, index, args):
+    """
+    Environment of one worker: TF_CONFIG describes the cluster for MultiWorkerMirroredStrategy, and the
+    CPU threads are split between the workers so they do not oversubscribe the host.
+    """
+    env = dict(os.environ)
+    env["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}})
+    env["CUDA_VISIBLE_DEVICES"] = "" if args.devices == 'cpu' else str(index)
+    threads = str(max(1, (os.cpu_count() or 1) // args.num_workers))
+    env.setdefault("TF_NUM_INTRAOP_THREADS", threads)
+    env.setdefault("OMP_NUM_THREADS", threads)
+    return env
+
+
+def main(args, main_args):
+    cluster = {"worker": [f"{args.host}:{port}" for port in free_ports(args.num_workers)]}
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    workers = [
+        subprocess.Popen([sys.executable, main_path, *main_args, '--distributed'], env=worker_env(cluster, index, args))
+        for index in range(args.num_workers)
+    ]
+    # The collectives block until every worker joins, so one failed worker stops all of them
+    try:
+        while True:
+            exit_codes = [worker.poll() for worker in workers]
+            exit_code = next((code for code in exit_codes if code), 0)
+            if exit_code or all(code is not None for code in exit_codes):
+                break
+            time.sleep(1)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main(*parse_args())
@@ -5,7 +5,10 @@ from miditok import REMI, TokenizerConfig
 import symusic
 
 from model.model import AccompanimentModel, accuracy_function, loss_function
-from model.decoder import TransformerDecoder
+from model.decoder import TransformerDecoder, fuse_attention
+from model.dataset import shard_paths, read_pairs, read_packed, count_rows, split_sizes, split_pairs, distribute_pairs, pitch_shift_table
+from model.checkpointing import TrainingCheckpoint
+from data_preprocessing.packing import MAX_SEGMENTS
 from model.transformer import AttentionHead
 import model.transformer
 
@@ -15,7 +18,8 @@ import tensorflow as tf
 from typing import Optional
 from types import SimpleNamespace
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+# launch_workers.py picks the devices of each worker itself
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
 
 
 # Check the number of available GPUs
@@ -23,8 +27,6 @@ num_gpus = len(tf.config.experimental.list_physical_devices('GPU'))
 print(f"Number of GPUs available: {num_gpus}")
 
 
-tf.compat.v1.enable_eager_execution() # Required to not break tf.where for mask
-
 config = TokenizerConfig(num_velocities=16)
 tokenizer = REMI(config)
 
@@ -35,60 +37,97 @@ def parse_args(args=None):
     parser.add_argument('--epochs',         type=int,   default=3,      help='Number of epochs used in training.')
     parser.add_argument('--lr',             type=float, default=1e-3,   help='Model\'s learning rate')
     parser.add_argument('--optimizer',      type=str,   default='adam', choices=['adam', 'rmsprop', 'sgd'], help='Model\'s optimizer')
-    parser.add_argument('--batch_size',     type=int,   default=50,     help='Model\'s batch size.')
-    parser.add_argument('--hidden_size',    type=int,   default=256,    help='Hidden size used to instantiate the model.')
+    parser.add_argument('--batch_size',     type=int,   default=50,     help='Model\'s (global) batch size, split across replicas when distributed.')
+    parser.add_argument('--accum_steps',    type=int,   default=1,      help='Batches of --batch_size whose gradients are accumulated into one optimizer step')
+    parser.add_argument('--hidden_size',    type=int,   default=512,    help='Hidden size used to instantiate the model (e.g. 128 for a speculative decoding draft).')
+    parser.add_argument('--num_heads',      type=int,   default=3,      help='Number of attention heads (any number with --fused_attention, otherwise 3).')
+    parser.add_argument('--fused_attention', action='store_true',       help='Use the fused multi-head attention layer; loaded checkpoints are converted.')
     parser.add_argument('--window_size',    type=int,   default=20,     help='Window size of text entries.')
     parser.add_argument('--chkpt_path',     default='src/saved_models/model_duet.h5',                 help='where the model checkpoint is')
+    parser.add_argument('--chkpt_dir',      default='src/saved_models/checkpoints', help='Where training checkpoints are written, empty to disable')
+    parser.add_argument('--chkpt_every',    type=int,   default=500,    help='Write a training checkpoint every this many optimizer steps (and after every epoch), 0 for epochs only')
+    parser.add_argument('--chkpt_keep',     type=int,   default=3,      help='Number of training checkpoints kept')
+    parser.add_argument('--resume',         action='store_true',        help='Continue training from the latest checkpoint in --chkpt_dir, at the batch it stopped')
+    parser.add_argument('--seed',           type=int,   default=None,   help='Seed of the weight initialization and the shuffle, random if not given (a resumed run keeps the seeds of its checkpoint)')
+    parser.add_argument('--log_every',      type=int,   default=50,     help='Print running metrics every this many batches (each print syncs with the device)')
+    parser.add_argument('--precision',      default='float32',          choices=['float32', 'mixed_bfloat16', 'mixed_float16'], help='Keras dtype policy; mixed policies keep variables, softmax, layer norm and the loss in float32')
+    parser.add_argument('--jit_compile',    action='store_true',        help='Compile the train/eval steps with XLA')
+    parser.add_argument('--shard_dir',      default='src/data_preprocessing/transformer_input_label/shards', help='Pair shards written by preprocess.py; falls back to the pickled pairs if empty')
+    parser.add_argument('--packed',         action='store_true',        help='Train on the packed shards: several shorter segments per row, so no position is spent on padding')
+    parser.add_argument('--max_segments',   type=int,   default=MAX_SEGMENTS, help='Segments per packed row, at least what preprocess.py packed with')
+    parser.add_argument('--transpose',      type=int,   default=0,      help='Transpose every training pair by a random number of semitones, up to this many up or down (0 to disable)')
+    parser.add_argument('--tokenizer_path', default='src/data_preprocessing/tokenizers/tokenizer.pkl', help='Tokenizer preprocess.py saved; its vocab tells --transpose which tokens are pitches')
+    parser.add_argument('--shuffle_buffer', type=int,   default=10000,  help='Number of training pairs shuffled together')
+    parser.add_argument('--cache',          default=None,               help="Cache decoded pairs after the first epoch: 'memory' or a file prefix")
+    parser.add_argument('--distributed',    action='store_true',        help='Data-parallel training with MultiWorkerMirroredStrategy, cluster taken from TF_CONFIG (see launch_workers.py)')
     parser.add_argument('--check_valid',    default=True,               action="store_true",  help='if training, also print validation after each epoch')
     if args is None: 
-        return parser.parse_args()      ## For calling through command line
-    return parser.parse_args(args)      ## For calling through notebook.
+        args = parser.parse_args()      ## For calling through command line
+    else:
+        args = parser.parse_args(args)  ## For calling through notebook.
+    if args.distributed and args.jit_compile:
+        parser.error("--jit_compile cannot compile the cross-worker all-reduce, use it without --distributed")
+    return args
 
 
 def main(args):
+    # MultiWorkerMirroredStrategy has to exist before TensorFlow runs anything else
+    strategy = tf.distribute.MultiWorkerMirroredStrategy() if args.distributed else tf.distribute.get_strategy()
+    # Every replica splits its share of the batch * accum_steps pairs into accum_steps micro-batches
+    if args.accum_steps > 1 and args.batch_size % strategy.num_replicas_in_sync:
+        raise ValueError(f"--batch_size {args.batch_size} has to be a multiple of the {strategy.num_replicas_in_sync} "
+                         f"replicas to split it into --accum_steps {args.accum_steps} micro-batches on every replica")
+    # Has to be set before any layer is built, including when loading a model
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    if args.seed is not None:
+        tf.keras.utils.set_random_seed(args.seed)
+        tf.random.set_global_generator(tf.random.Generator.from_seed(args.seed))
 
     ##############################################################################
-    ## Data Loading: These are lists of lists of ID integers. Need to fit them through an embedding layer.
-    with open('src/data_preprocessing/transformer_input_label/input_tokens.pkl', 'rb') as f:
-        input_tokens = pickle.load(f)
-    with open('src/data_preprocessing/transformer_input_label/label_tokens.pkl', 'rb') as f:
-        label_tokens = pickle.load(f)
-    with open('src/data_preprocessing/tokenizers/tokenizer.pkl', 'rb') as f:
-        tokenizer = pickle.load(f)
+    ## Data Loading: (input, label) windows of token ids, streamed through tf.data
+    paths = shard_paths(args.shard_dir, packed=args.packed)
+    if args.packed:
+        if not paths:
+            raise FileNotFoundError(f"No packed shards in '{args.shard_dir}', run preprocess.py to write them")
+        # (captions, per-segment melodies, segment ids) rows instead of pairs
+        pairs = read_packed(paths, args.max_segments)
+        num_pairs = count_rows(paths)
+    elif paths:
+        pairs = read_pairs(paths)
+        num_pairs = count_rows(paths)
+    else:
+        # Pickled pairs from before preprocess.py wrote shards
+        with open('src/data_preprocessing/transformer_input_label/input_tokens.pkl', 'rb') as f:
+            input_tokens = pickle.load(f)
+        with open('src/data_preprocessing/transformer_input_label/label_tokens.pkl', 'rb') as f:
+            label_tokens = pickle.load(f)
+        pairs = tf.data.Dataset.from_tensor_slices((np.array(input_tokens), np.array(label_tokens)))
+        num_pairs = len(input_tokens)
     print("Data loaded!")
 
-    l = len(input_tokens)
-
-    vocab = tokenizer.vocab
-    inv_vocab = {v: k for k, v in vocab.items()}
-    
-    word2idx = vocab
-    idx2word = inv_vocab
-    input = np.array(input_tokens)
-    label = np.array(label_tokens)
-
-    # Shuffling the input and label arrays with the same indices to maintain alignment
-    indices = np.arange(len(input))
-    np.random.shuffle(indices)
-    input = input[indices]
-    label = label[indices]
-    print("Data shuffled!")
-
-    split = int(l * 0.8)
-    train_input = input[:split]
-    train_label = label[:split]
-    test_input = input[split:]
-    test_label = label[split:]
-    print("Data preprocessed!")
-
-    train_input  = train_input
-    test_input   = test_input
-    train_label = train_label
-    test_label  = test_label
-    # train_images    = img_prep(data_dict['train_images'])
-    # test_images     = img_prep(data_dict['test_images'])
-    # word2idx        = data_dict['word2idx']
-    # idx2word        = data_dict['idx2word']
+    # The model predicts the input window conditioned on the label window. Every worker keeps its own
+    # share of the pairs and batches them to the per-replica batch size, all of them to the same number of steps.
+    train_pairs, test_pairs = split_pairs(pairs)
+    num_train, num_test = split_sizes(num_pairs)
+    worker = worker_id(strategy)
+    # The training pipeline is rebuilt every epoch (see train_model), on top of a cache built only once
+    if args.cache is not None:
+        train_pairs = train_pairs.cache('' if args.cache == 'memory' else cache_path(args.cache, 'train', worker))
+
+    # Transposed copies are made on the fly instead of being stored (see model.dataset.transpose_batch)
+    transpose_table = None
+    if args.transpose:
+        with open(args.tokenizer_path, 'rb') as f:
+            transpose_table = pitch_shift_table(pickle.load(f).vocab, args.transpose)
+
+    def train_data(seed, skip=0):
+        # One training element holds the accum_steps micro-batches of an optimizer step
+        return distribute_pairs(
+            strategy, lambda: train_pairs, args.batch_size * args.accum_steps, num_pairs=num_train,
+            shuffle_buffer=args.shuffle_buffer, seed=seed, skip=skip, transpose_table=transpose_table,
+        )
+    test_data  = distribute_pairs(strategy, lambda: test_pairs,  args.batch_size, num_pairs=num_test, cache=cache_path(args.cache, 'test', worker))
+    print(f"Data pipeline built! ({strategy.num_replicas_in_sync} replica(s), this is worker {worker})")
 
     ##############################################################################
     ## Training Task
@@ -106,25 +145,43 @@ def main(args):
         #     window_size = args.window_size
         # )
         # Vocab size depends on data -- TODO: Save the vocab size when preprocessing, then use it here
-        decoder = TransformerDecoder(vocab_size=290, hidden_size=512, window_size=63)
-        model = AccompanimentModel(decoder)
-        print("Model constructed!")
-
-
-        # Compile the model
-        
-        compile_model(model, args)
-        print("Model compiled!")
+        # Variables created in the strategy scope are mirrored on every replica
+        with strategy.scope():
+            decoder = TransformerDecoder(vocab_size=290, hidden_size=args.hidden_size, window_size=63, num_heads=args.num_heads, fused_attention=args.fused_attention)
+            model = AccompanimentModel(decoder)
+            print("Model constructed!")
+
+
+            # Compile the model
+
+            compile_model(model, args)
+            print("Model compiled!")
+        checkpoint = TrainingCheckpoint(
+            model, args.chkpt_dir,
+            every       = args.chkpt_every,
+            keep        = args.chkpt_keep,
+            seed        = args.seed,
+            global_seed = args.seed,
+            write       = is_chief(strategy),
+        )
+        if args.resume:
+            restored = checkpoint.restore()
+            print(f"Resuming from {restored}: epoch {checkpoint.epoch_count}, batch {checkpoint.batch_count}" if restored
+                  else f"No checkpoint in '{args.chkpt_dir}', training from scratch")
         model_stats = train_model(
-            model, train_input, train_label, 0, args, 
-            valid = (test_input, test_label)
+            model, train_data, 0, args,
+            valid = test_data,
+            checkpoint = checkpoint,
         )
-        with open('src/stats/model_stats.pkl', 'wb') as f:
-            pickle.dump(model_stats, f)
-        print("Model statistics saved to src/stats/model_stats.pkl")
         print("Model trained!")
+        # Every worker holds the same weights, only one of them writes
+        if is_chief(strategy):
+            os.makedirs('src/stats', exist_ok=True)
+            with open('src/stats/model_stats.pkl', 'wb') as f:
+                pickle.dump(model_stats, f)
+            print("Model statistics saved to src/stats/model_stats.pkl")
         # model.fit(train_input, train_label, batch_size=args.batch_size, epochs=args.epochs)
-        if args.chkpt_path: 
+        if args.chkpt_path and is_chief(strategy):
             ## Save model to run testing task afterwards
             save_model(model, args)
                 
@@ -133,9 +190,10 @@ def main(args):
     if args.task in ('test', 'both'):
         if args.task != 'both': 
             ## Load model for testing. Note that architecture needs to be consistent
-            model = load_model(args)
+            with strategy.scope():
+                model = load_model(args)
         if not (args.task == 'both' and args.check_valid):
-            perp, acc = test_model(model, test_input, test_label, 0, args)
+            perp, acc = test_model(model, test_data, 0, args)
             print(f"Perplexity: {perp}, Accuracy: {acc}")
 
     ##############################################################################
@@ -172,6 +230,8 @@ def load_model(args):
     model.test    = partial(AccompanimentModel.test,    model)
     model.train   = partial(AccompanimentModel.train,   model)
     model.compile = partial(AccompanimentModel.compile, model)
+    if args.fused_attention:
+        model.decoder = fuse_attention(model.decoder)
     compile_model(model, args)
     print(f"Model loaded from '{args.chkpt_path}'")
     return model
@@ -180,36 +240,74 @@ def load_model(args):
 def compile_model(model, args):
     '''Compiles model by reference based on arguments'''
     optimizer = tf.keras.optimizers.get(args.optimizer).__class__(learning_rate = args.lr)
+    if args.precision == 'mixed_float16':
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
     model.compile(
         optimizer   = optimizer,
         loss        = loss_function,
-        metrics     = [accuracy_function]
+        metrics     = [accuracy_function],
+        jit_compile = args.jit_compile,
+        accum_steps = args.accum_steps,
     )
 
 
-def train_model(model, captions, img_feats, pad_idx, args, valid):
-    '''Trains model and returns model statistics'''
+def cache_path(cache, split, worker=0):
+    '''tf.data cache argument for one split and worker, so caches do not collide on disk'''
+    if cache is None or cache == 'memory':
+        return cache
+    return f"{cache}_{split}" if worker == 0 else f"{cache}_{split}_{worker}"
+
+
+def worker_id(strategy):
+    '''Index of this process among the workers, 0 when not distributed'''
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    return resolver.task_id if resolver is not None and resolver.task_id is not None else 0
+
+
+def is_chief(strategy):
+    '''Whether this process writes stats and checkpoints: the chief task, or worker 0 if there is none'''
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or resolver.task_type is None:
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    return resolver.task_type == 'worker' and resolver.task_id == 0 and 'chief' not in resolver.cluster_spec().as_dict()
+
+
+def train_model(model, train_data, pad_idx, args, valid, checkpoint):
+    '''
+    Trains model and returns model statistics. train_data(seed, skip) builds the pipeline of one epoch: it
+    is shuffled with the checkpointed seed plus the epoch, so a resumed epoch replays the same order and
+    starts after the batches the checkpoint had already trained on.
+    '''
     stats = []
+    epoch = checkpoint.epoch_count
     try:
-        for epoch in range(args.epochs):
+        for epoch in range(checkpoint.epoch_count, args.epochs):
             print("training model!")
-            stats += [model.train(captions, img_feats, pad_idx, batch_size=args.batch_size)]
+            start_batch = checkpoint.batch_count
+            epoch_data = train_data(int(checkpoint.seed) + epoch, skip=start_batch)
+            stats += [model.train(epoch_data, pad_idx, log_every=args.log_every, start_batch=start_batch, on_batch=checkpoint.after_batch)]
+            checkpoint.end_epoch()
+            checkpoint.save()
             print("training model done!")
             if args.check_valid:
                 print("testing model!")
-                stats += [model.test(valid[0], valid[1], pad_idx, batch_size=args.batch_size)]
+                stats += [model.test(valid, pad_idx, log_every=args.log_every)]
     except KeyboardInterrupt as e:
         if epoch > 0:
             print("Key-value interruption. Trying to early-terminate. Interrupt again to not do that!")
         else: 
             raise e
+    finally:
+        checkpoint.sync()
         
     return stats
 
 
-def test_model(model, captions, img_feats, pad_idx, args):
+def test_model(model, test_data, pad_idx, args):
     '''Tests model and returns model statistics'''
-    perplexity, accuracy = model.test(captions, img_feats, pad_idx, batch_size=args.batch_size)
+    perplexity, accuracy = model.test(test_data, pad_idx, log_every=args.log_every)
     return perplexity, accuracy
 
 
@@ -0,0 +1,92 @@
+import numpy as np
+import tensorflow as tf
+
+from model.model import AccompanimentModel, step_metrics
+
+
+class TrainingCheckpoint:
+    """
+    Step-based checkpoints of everything needed to continue training where it stopped: model, optimizer,
+    the running metrics of the epoch, the global RNG, the data shuffle seed, TensorFlow's global seed (which
+    tf.data combines with the shuffle seed) and the position in the data (epoch and batches done in it). Checkpoints are written by a background thread, so training only
+    waits for the variables to be copied, and only the last `keep` of them are kept.
+
+    Resuming rebuilds the epoch with the same shuffle seed and skips the batches already trained on (see
+    main.py), so the model sees exactly the batches an uninterrupted run would have.
+    """
+
+    def __init__(self, model, directory, every=500, keep=3, seed=None, global_seed=None, write=True, async_write=True):
+        """
+        :param model: compiled AccompanimentModel; its optimizer is checkpointed too
+        :param directory: where checkpoints are written to and restored from, empty to only track the position
+        :param every: save every this many optimizer steps, 0 to only save when asked
+        :param keep: number of checkpoints kept on disk
+        :param seed: shuffle seed of a fresh run, random if None; a restored run uses the saved one
+        :param global_seed: seed passed to tf.random.set_seed by this run, if any; a restored run sets the saved one
+        :param write: False on the workers that only restore (every worker holds the same state)
+        """
+        self.every = every
+        self.write = write
+        if seed is None:
+            seed = np.random.randint(2**31)
+        with tf.init_scope():
+            self.seed  = tf.Variable(seed, dtype=tf.int64, trainable=False)
+            # -1 when the run set no global seed
+            self.global_seed = tf.Variable(-1 if global_seed is None else global_seed, dtype=tf.int64, trainable=False)
+            self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+            self.batch = tf.Variable(0, dtype=tf.int64, trainable=False)
+            self.step  = tf.Variable(0, dtype=tf.int64, trainable=False)
+        # Counted on the host, so a step only touches the variables when it saves
+        self.epoch_count = self.batch_count = self.step_count = 0
+        self.checkpoint = tf.train.Checkpoint(
+            model       = model,
+            optimizer   = model.optimizer,
+            metrics     = step_metrics(model, AccompanimentModel.train_batch),
+            rng         = tf.random.get_global_generator(),
+            seed        = self.seed,
+            global_seed = self.global_seed,
+            epoch       = self.epoch,
+            batch       = self.batch,
+            step        = self.step,
+        )
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=keep, step_counter=self.step) if directory else None
+        self.options = tf.train.CheckpointOptions(enable_async=async_write)
+
+    def restore(self):
+        """
+        Restores the latest checkpoint, if any. Variables not built yet are restored when they are created.
+        The global seed is set back to the one of the checkpointed run, so the shuffle replays its order
+        whether or not this run was given the same --seed.
+        """
+        path = self.manager.latest_checkpoint if self.manager is not None else None
+        if path is None:
+            return None
+        self.checkpoint.restore(path)
+        global_seed = int(self.global_seed)
+        tf.random.set_seed(global_seed if global_seed >= 0 else None)
+        self.epoch_count, self.batch_count, self.step_count = int(self.epoch), int(self.batch), int(self.step)
+        return path
+
+    def after_batch(self, index=None):
+        '''Called after every optimizer step (AccompanimentModel.train's on_batch)'''
+        self.batch_count += 1
+        self.step_count += 1
+        if self.every and self.step_count % self.every == 0:
+            self.save()
+
+    def end_epoch(self):
+        self.epoch_count += 1
+        self.batch_count = 0
+
+    def save(self):
+        '''Starts writing a checkpoint of the current state, returns its path (None on non-writing workers)'''
+        if not self.write or self.manager is None:
+            return None
+        self.epoch.assign(self.epoch_count)
+        self.batch.assign(self.batch_count)
+        self.step.assign(self.step_count)
+        return self.manager.save(checkpoint_number=self.step_count, options=self.options)
+
+    def sync(self):
+        '''Waits for a checkpoint still being written in the background'''
+        self.checkpoint.sync()
@@ -0,0 +1,226 @@
+import os
+import glob
+import numpy as np
+import tensorflow as tf
+
+from model.transformer import segment_positions
+
+
+def shard_paths(shard_dir, packed=False):
+    '''Pair (or packed) shards written by data_preprocessing/shards.py, in order'''
+    return sorted(glob.glob(os.path.join(shard_dir, 'packed_*.npy' if packed else 'pairs_*.npy')))
+
+
+def read_pairs(paths, cycle_length=4):
+    """
+    Streams (captions, image_features) pairs from pair shards. Shards are memory-mapped and read
+    cycle_length at a time in parallel, so only a few of them are resident at once and the dataset never
+    has to be loaded as one array. The order is deterministic, which split_pairs relies on.
+
+    :param paths: shard paths, e.g. from shard_paths
+    :return: dataset of (input window, label window) int32 pairs
+    """
+    def unpack(pair):
+        return pair[0], pair[1]
+
+    return read_rows(paths, cycle_length).map(unpack, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def read_packed(paths, max_segments, cycle_length=4):
+    """
+    read_pairs for packed shards (data_preprocessing/packing.py). Every row holds several segments; the
+    melody of each segment is moved to its own row of image_features, starting at index 0, which is where
+    an unpacked melody of that length would be.
+
+    :param paths: packed shard paths, e.g. from shard_paths(shard_dir, packed=True)
+    :param max_segments: most segments in a row, at least the max_segments the shards were packed with
+    :return: dataset of (captions [window_size], image_features [max_segments x window_size],
+        segment_ids [window_size]) int32 triples
+    """
+    window_size = np.load(paths[0], mmap_mode='r').shape[-1]
+
+    def unpack(row):
+        captions, melodies, segment_ids = row[0], row[1], row[2]
+        positions = segment_positions(segment_ids[tf.newaxis], max_segments)[0]
+        is_token = segment_ids > 0
+        indices = tf.stack([segment_ids - 1, positions], axis=-1)
+        image_features = tf.scatter_nd(
+            tf.boolean_mask(indices, is_token), tf.boolean_mask(melodies, is_token), [max_segments, window_size],
+        )
+        return captions, image_features, segment_ids
+
+    return read_rows(paths, cycle_length).map(unpack, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def read_rows(paths, cycle_length=4):
+    '''
+    int32 rows of the shards at paths, shards memory-mapped and interleaved in a deterministic order. Shards
+    are stored as uint16 (older ones as int32) and widened a whole shard at a time.
+    '''
+    first_shard = np.load(paths[0], mmap_mode='r')
+    row_shape, dtype = first_shard.shape[1:], tf.as_dtype(first_shard.dtype)
+
+    def load_shard(path):
+        yield np.load(path.decode(), mmap_mode='r')
+
+    def widen(shard):
+        return tf.cast(shard, tf.int32)
+
+    def shard_rows(path):
+        shard = tf.data.Dataset.from_generator(
+            load_shard, args=(path,),
+            output_signature=tf.TensorSpec([None, *row_shape], dtype),
+        )
+        return shard.map(widen).unbatch()
+
+    return tf.data.Dataset.from_tensor_slices(paths).interleave(
+        shard_rows, cycle_length=cycle_length, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True,
+    )
+
+
+def count_rows(paths):
+    '''Number of rows (pairs or packed rows) in the shards at paths, read from the .npy headers only'''
+    return sum(np.load(path, mmap_mode='r').shape[0] for path in paths)
+
+
+def split_sizes(num_pairs, holdout_every=5):
+    '''(train, test) sizes of split_pairs over num_pairs pairs'''
+    num_test = num_pairs // holdout_every
+    return num_pairs - num_test, num_test
+
+
+def split_pairs(pairs, holdout_every=5):
+    """
+    Deterministic train/test split that holds out every holdout_every-th pair (20% by default), so the
+    test set stays the same from run to run without ever materializing the data.
+
+    :return: (train pairs, test pairs)
+    """
+    def is_test(i, pair):
+        return i % holdout_every == holdout_every - 1
+
+    def is_train(i, pair):
+        return tf.logical_not(is_test(i, pair))
+
+    def drop_index(i, pair):
+        return pair
+
+    indexed = pairs.enumerate()
+    return indexed.filter(is_train).map(drop_index), indexed.filter(is_test).map(drop_index)
+
+
+def pitch_shift_table(vocab, max_shift):
+    """
+    Lookup table of the token ids of every transposition from -max_shift to max_shift semitones. Pitch
+    tokens ('Pitch_<midi pitch>' in the tokenizer vocab) map to the pitch shifted by that many semitones,
+    or to -1 if the vocab has no such pitch; every other token maps to itself.
+
+    :param vocab: tokenizer vocab, {token name: id}
+    :return: int32 array [2 * max_shift + 1 x vocab size], row max_shift being no transposition
+    """
+    pitches = {}
+    for name, index in vocab.items():
+        kind, _, value = name.partition('_')
+        if kind == 'Pitch' and value.isdigit():
+            pitches[int(value)] = index
+    vocab_size = max(vocab.values()) + 1
+    table = np.tile(np.arange(vocab_size, dtype=np.int32), [2 * max_shift + 1, 1])
+    for row, shift in enumerate(range(-max_shift, max_shift + 1)):
+        for pitch, index in pitches.items():
+            table[row, index] = pitches.get(pitch + shift, -1)
+    return table
+
+
+def transpose_batch(table, seed, index, captions, image_features, *rest):
+    """
+    Transposes every pair of a batch (captions and image_features together) by its own random number of
+    semitones, drawn uniformly from the rows of table that keep all of the pair's pitches in the vocab. The
+    draw only depends on seed and the batch index, so an epoch and a resumed epoch transpose alike.
+
+    :param table: pitch_shift_table
+    :param seed: int64 [2] seed of the stateless draws
+    :param index: index of the batch in the epoch
+    :return: the batch, transposed; further elements (segment ids) are passed through
+    """
+    batch_size = tf.shape(captions)[0]
+    tokens = tf.concat([tf.reshape(captions, [batch_size, -1]), tf.reshape(image_features, [batch_size, -1])], axis=1)
+    # [num_shifts x batch_size x tokens]
+    shifted = tf.gather(table, tokens, axis=1)
+    valid = tf.reduce_all(shifted >= 0, axis=-1)
+    draws = tf.random.stateless_uniform(tf.shape(valid), seed=tf.random.experimental.stateless_fold_in(seed, index))
+    shifts = tf.argmax(tf.where(valid, draws, -1.0), axis=0)
+    tokens = tf.gather(tf.transpose(shifted, [1, 0, 2]), shifts, batch_dims=1)
+    num_captions = tf.size(captions) // batch_size
+    captions = tf.reshape(tokens[:, :num_captions], tf.shape(captions))
+    image_features = tf.reshape(tokens[:, num_captions:], tf.shape(image_features))
+    return (captions, image_features, *rest)
+
+
+def batch_pairs(pairs, batch_size, shuffle_buffer=0, cache=None, seed=None, skip=0, num_batches=None, transpose_table=None, transpose_stream=0,
+                drop_remainder=True):
+    """
+    Input pipeline for AccompanimentModel.train/test: optional cache, shuffle buffer, parallel batching,
+    optional transposition and prefetch, so the next batches are prepared while the current one is on the
+    device. Like the old slicing loop, only full batches are kept unless drop_remainder is False.
+
+    :param pairs: dataset of (captions, image_features) pairs
+    :param shuffle_buffer: number of pairs shuffled together, 0 to keep the order (e.g. for testing)
+    :param cache: None, 'memory', or a file prefix to cache the decoded pairs to after the first epoch
+    :param seed: shuffle (and transposition) seed
+    :param skip: number of batches dropped from the start, to resume an epoch where a checkpoint left it
+    :param num_batches: most batches of an epoch (skipped ones included), None for all full batches
+    :param transpose_table: pitch_shift_table to transpose the pairs with (see transpose_batch), None to keep them
+    :param transpose_stream: told apart from other pipelines with the same seed, so they transpose differently
+    :param drop_remainder: False to keep a last, smaller batch, e.g. to evaluate on exactly the given pairs
+    :return: dataset of (captions, image_features) batches
+    """
+    if cache is not None:
+        pairs = pairs.cache('' if cache == 'memory' else cache)
+    if shuffle_buffer:
+        pairs = pairs.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    pairs = pairs.batch(batch_size, drop_remainder=drop_remainder, num_parallel_calls=tf.data.AUTOTUNE)
+    if num_batches is not None:
+        pairs = pairs.take(num_batches)
+    if skip:
+        pairs = pairs.skip(skip)
+    if transpose_table is not None:
+        table = tf.constant(transpose_table)
+        transpose_seed = tf.constant([np.random.randint(2**31) if seed is None else seed, transpose_stream], dtype=tf.int64)
+
+        def transpose(index, batch):
+            return transpose_batch(table, transpose_seed, index, *batch)
+
+        pairs = pairs.enumerate(skip).map(transpose, num_parallel_calls=tf.data.AUTOTUNE)
+    return pairs.prefetch(tf.data.AUTOTUNE)
+
+
+def distribute_pairs(strategy, pairs_fn, global_batch_size, num_pairs=None, **batch_kwargs):
+    """
+    batch_pairs for data-parallel training: every input pipeline (one per worker) keeps a disjoint
+    1/num_input_pipelines of the pairs and batches them to the per-replica batch size, so one step over all
+    replicas sees global_batch_size pairs.
+
+    The shares can differ by a pair, and so by a batch. A worker with one batch more would wait forever in
+    the all-reduce of a step the others never run, so given num_pairs every pipeline stops after the steps
+    the smallest share fills.
+
+    :param strategy: tf.distribute strategy the model was built under
+    :param pairs_fn: builds the (undistributed) pairs dataset; called once per worker
+    :param num_pairs: number of pairs pairs_fn gives (e.g. from count_rows and split_sizes), None to batch all of them
+    :param batch_kwargs: passed on to batch_pairs (shuffle_buffer, cache, seed, skip, transpose_table)
+    :return: distributed dataset of (captions, image_features) batches
+    """
+    def dataset_fn(input_context):
+        pairs = pairs_fn().shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        num_batches = None
+        if num_pairs is not None:
+            # A step takes one batch per replica of the worker
+            replicas = strategy.num_replicas_in_sync // input_context.num_input_pipelines
+            num_batches = num_pairs // input_context.num_input_pipelines // (batch_size * replicas) * replicas
+        return batch_pairs(
+            pairs, batch_size, num_batches=num_batches,
+            transpose_stream=input_context.input_pipeline_id, **batch_kwargs,
+        )
+
+    return strategy.distribute_datasets_from_function(dataset_fn)
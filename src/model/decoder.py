@@ -1,37 +1,140 @@
 import tensorflow as tf
 import numpy as np
 
-from model.transformer import TransformerBlock, PositionalEncoding
+from model.transformer import TransformerBlock, PositionalEncoding, same_segment, segment_positions, static_size
 
 
 class TransformerDecoder(tf.keras.Model):
-    def __init__(self, vocab_size, hidden_size, window_size, **kwargs):
+    def __init__(self, vocab_size, hidden_size, window_size, num_heads=3, fused_attention=False, **kwargs):
 
         super().__init__(**kwargs)
         self.vocab_size  = vocab_size
         self.hidden_size = hidden_size
         self.window_size = window_size
+        self.num_heads   = num_heads
+        self.fused_attention = fused_attention
 
         # Define feed forward layer(s) to embed image features into a vector 
-        self.image_embedding = tf.keras.layers.Dense(hidden_size, activation = 'relu')
+        # Kept in float32 under mixed precision: the inputs are raw token ids, which bfloat16 cannot hold exactly
+        self.image_embedding = tf.keras.layers.Dense(hidden_size, activation = 'relu', dtype='float32')
 
         # Define positional encoding to embed and offset layer for language:
         self.encoding = PositionalEncoding(vocab_size, hidden_size, window_size)
 
         # Define transformer decoder layer:
-        self.decoder = TransformerBlock(hidden_size)
+        self.decoder = TransformerBlock(hidden_size, num_heads=num_heads, fused=fused_attention)
 
         # Define classification layer(s) (LOGIT OUTPUT)
         self.classifier = tf.keras.layers.Dense(vocab_size)
 
-    def call(self, encoded_images, captions):
-        img_embeds = self.image_embedding(tf.expand_dims(encoded_images, 1))
+    def call(self, encoded_images, captions, segment_ids=None):
+        """
+        :param encoded_images: melody token ids [BATCH_SIZE x MELODY_LENGTH], or for packed rows one melody per
+            segment [BATCH_SIZE x MAX_SEGMENTS x MELODY_LENGTH]
+        :param captions: harmony token ids [BATCH_SIZE x WINDOW_SIZE]
+        :param segment_ids: packed rows only, segment of every caption position [BATCH_SIZE x WINDOW_SIZE]: 1..MAX_SEGMENTS,
+            0 for padding. Segment s restarts the positions, only attends to itself and is conditioned on melody s - 1.
+        :return: logits [BATCH_SIZE x WINDOW_SIZE x vocab_size]
+        """
+        img_embeds = self.embed_context(encoded_images)
         # print("got img_embeds")
-        capt_embeds = self.encoding(captions)
-        # print("got capt_embeds")
-        # print(np.shape(img_embeds), np.shape(capt_embeds))
-        decode_out = self.decoder(capt_embeds, img_embeds)
+        # Pad tokens are hidden from self-attention
+        key_padding_mask = tf.not_equal(captions, 0)
+        if segment_ids is None:
+            capt_embeds = self.encoding(captions)
+            # print("got capt_embeds")
+            # print(np.shape(img_embeds), np.shape(capt_embeds))
+            decode_out = self.decoder(capt_embeds, img_embeds, key_padding_mask=key_padding_mask)
+        else:
+            num_segments = static_size(encoded_images, 1)
+            capt_embeds = self.encoding(captions, positions=segment_positions(segment_ids, num_segments))
+            context_segments = tf.range(1, num_segments + 1, dtype=segment_ids.dtype)[tf.newaxis]
+            decode_out = self.decoder(
+                capt_embeds, img_embeds,
+                key_padding_mask        = key_padding_mask,
+                self_attention_mask     = same_segment(segment_ids, segment_ids),
+                context_attention_mask  = same_segment(segment_ids, context_segments),
+            )
         # print("got decode_out")
-        logits = self.classifier(decode_out)
+        # Logits (and so the softmax and loss) are float32 whatever the policy
+        logits = tf.cast(self.classifier(decode_out), tf.float32)
         # print("got logits")
         return logits
+
+    def get_config(self):
+        return {
+            "vocab_size":  self.vocab_size,
+            "hidden_size": self.hidden_size,
+            "window_size": self.window_size,
+            "num_heads":   self.num_heads,
+            "fused_attention": self.fused_attention,
+        }
+
+    def get_build_config(self):
+        # Keras builds a reloaded model from one input shape, which call() does not take; the melody length is
+        # enough to create the weights with a dummy call instead (see build_from_config)
+        if not self.built:
+            return None
+        return {"melody_length": int(self.image_embedding.kernel.shape[0])}
+
+    def build_from_config(self, config):
+        self(tf.zeros([1, config["melody_length"]], tf.int32), tf.zeros([1, 1], tf.int32))
+
+    def encode_context(self, encoded_images):
+        """
+        Embeds the melody and projects the context attention keys/values once, so they can be reused by
+        every decode_step.
+
+        :param encoded_images: melody token ids [BATCH_SIZE x MELODY_LENGTH]
+        :return: (context sequence [BATCH_SIZE x 1 x hidden_size], projected context keys/values)
+        """
+        img_embeds = self.embed_context(encoded_images)
+        return img_embeds, self.decoder.project_context(img_embeds)
+
+    def embed_context(self, encoded_images):
+        '''Context sequence [BATCH_SIZE x 1 (or MAX_SEGMENTS) x hidden_size], in the compute dtype of the decoder'''
+        if len(encoded_images.shape) == 2:
+            encoded_images = tf.expand_dims(encoded_images, 1)
+        img_embeds = self.image_embedding(encoded_images)
+        return tf.cast(img_embeds, self.compute_dtype)
+
+    def init_cache(self, batch_size):
+        return self.decoder.init_cache(batch_size)
+
+    def decode_step(self, context, captions, position, cache):
+        """
+        Incremental version of call: only the newest tokens are run through the decoder, earlier positions
+        come from the self-attention cache. Gives the same logits as the matching rows of call.
+
+        :param context: output of encode_context
+        :param captions: newest tokens [BATCH_SIZE x NEW_POSITIONS]
+        :param position: window index of the first new token (i.e. number of tokens already cached)
+        :param cache: output of init_cache or of the previous decode_step
+        :return: logits [BATCH_SIZE x NEW_POSITIONS x vocab_size] and the extended cache
+        """
+        _, context_kv = context
+        capt_embeds = self.encoding.step(captions, position)
+        decode_out, cache = self.decoder.step(capt_embeds, context_kv, cache)
+        logits = tf.cast(self.classifier(decode_out), tf.float32)
+        return logits, cache
+
+
+def fuse_attention(decoder):
+    """
+    Copy of a (built) TransformerDecoder that uses FusedMultiHeadedAttention, with every weight taken over
+    from the original. This is how checkpoints trained with the per-head layers are loaded into the fused one.
+    """
+    if decoder.fused_attention:
+        return decoder
+    fused = TransformerDecoder(decoder.vocab_size, decoder.hidden_size, decoder.window_size, num_heads=decoder.num_heads, fused_attention=True)
+    melody_length = decoder.image_embedding.kernel.shape[0]
+    fused(tf.zeros([1, melody_length]), tf.zeros([1, decoder.window_size], dtype=tf.int64))
+
+    for layer in ('image_embedding', 'classifier'):
+        getattr(fused, layer).set_weights(getattr(decoder, layer).get_weights())
+    fused.encoding.embedding.set_weights(decoder.encoding.embedding.get_weights())
+    for layer in ('ff_layer', 'layer_norm1', 'layer_norm2', 'layer_norm3'):
+        getattr(fused.decoder, layer).set_weights(getattr(decoder.decoder, layer).get_weights())
+    fused.decoder.self_atten.load_heads(decoder.decoder.self_atten)
+    fused.decoder.self_context_atten.load_heads(decoder.decoder.self_context_atten)
+    return fused
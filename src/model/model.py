@@ -1,135 +1,212 @@
+import weakref
+import functools
 import numpy as np
 import tensorflow as tf
 import sys
 
+# Compiled train/eval steps per model, keyed by step, padding index and input signature
+_compiled_steps = weakref.WeakKeyDictionary()
+# Device-side metric accumulators per model, one per step
+_step_metrics = weakref.WeakKeyDictionary()
+
+
+class StreamingMetrics(tf.Module):
+    """
+    Running loss/accuracy sums of an epoch, kept in variables on the device. The compiled steps add to
+    them in-graph, so nothing is copied back to the host until result() is called. A tf.Module, so the
+    sums of an interrupted epoch can be checkpointed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        with tf.init_scope():
+            self.total_loss    = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+            self.total_seen    = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+            self.total_correct = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+
+    def reset(self):
+        for variable in (self.total_loss, self.total_seen, self.total_correct):
+            variable.assign(0.0)
+
+    def update(self, loss, num_predictions, num_correct):
+        self.total_loss.assign_add(tf.cast(loss, tf.float64))
+        self.total_seen.assign_add(tf.cast(num_predictions, tf.float64))
+        self.total_correct.assign_add(tf.cast(num_correct, tf.float64))
+
+    def result(self):
+        '''Reads the sums back (a host sync): average loss, accuracy and perplexity so far'''
+        total_seen = max(float(self.total_seen.numpy()), 1.0)
+        avg_loss = float(self.total_loss.numpy()) / total_seen
+        avg_acc = float(self.total_correct.numpy()) / total_seen
+        return avg_loss, avg_acc, np.exp(avg_loss)
+
+
 class AccompanimentModel(tf.keras.Model):
 
     def __init__(self, decoder, **kwargs):
         super().__init__(**kwargs)
         self.decoder = decoder
 
-    @tf.function
-    def call(self, melody, harmony):
+    def call(self, melody, harmony, segment_ids=None):
         # print("shapes before call")
         # print(np.shape(melody), np.shape(harmony))
         # melody = tf.keras.layers.Embedding(input_dim=self.decoder.vocab_size, output_dim=self.decoder.hidden_size)(melody)
         # harmony = tf.keras.layers.Embedding(input_dim=self.decoder.vocab_size, output_dim=self.decoder.hidden_size)(harmony)
         # print("Shapes after embedding")
         # print(np.shape(melody), np.shape(harmony))
-        output = self.decoder(melody, harmony)
+        output = self.decoder(melody, harmony, segment_ids=segment_ids)
         # print("output shape:")
         # print(np.shape(output))
         return output  
 
-    def compile(self, optimizer, loss, metrics):
+    def compile(self, optimizer, loss, metrics, jit_compile=False, accum_steps=1):
         '''
-        Create a facade to mimic normal keras fit routine
+        Create a facade to mimic normal keras fit routine. With jit_compile the train/eval steps are
+        compiled with XLA. With accum_steps > 1 every training batch is split into that many micro-batches
+        whose gradients are accumulated into one optimizer step.
         '''
         self.optimizer = optimizer
         self.loss_function = loss 
         self.accuracy_function = metrics[0]
+        self.jit_compile = jit_compile
+        self.accum_steps = accum_steps
+        _compiled_steps.pop(self, None)
 
-    def train(self, train_captions, train_image_features, padding_index, batch_size=30):
+    def train_batch(self, captions, image_features, segment_ids=None, padding_index=0):
+        """
+        One optimizer step. Traced by compiled_step, so everything here has to stay in TensorFlow.
+
+        The batch is run as accum_steps micro-batches (see compile), one at a time, so only one micro-batch
+        of activations is alive at once. The gradient is the mean over every predicted token of the step,
+        across micro-batches and replicas, whatever the padding of each micro-batch.
+
+        :param captions: batch of windows [BATCH_SIZE x WINDOW_SIZE + 1], decoder input and labels
+        :param image_features: batch of conditioning windows [BATCH_SIZE x MELODY_LENGTH], or
+            [BATCH_SIZE x MAX_SEGMENTS x MELODY_LENGTH] for packed rows
+        :param segment_ids: packed rows only, segment of every captions position [BATCH_SIZE x WINDOW_SIZE + 1]
+        :return: summed loss, number of predicted tokens and number of correct predictions
+        """
+        num_tokens = tf.reduce_sum(tf.cast(label_mask(captions, padding_index, segment_ids), tf.float32))
+        num_tokens = tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, num_tokens)
+        # A step without any label would divide by zero, its gradient is zero anyway
+        num_tokens = tf.maximum(num_tokens, 1.0)
+        batch = (captions, image_features) if segment_ids is None else (captions, image_features, segment_ids)
+        accum_steps = getattr(self, 'accum_steps', 1)
+        if accum_steps == 1:
+            grads, metrics = self.micro_batch_gradients(num_tokens, padding_index, *batch)
+        else:
+            micro_batches = [split_micro_batches(tensor, accum_steps) for tensor in batch]
+
+            def accumulate(i, grads, metrics):
+                step_grads, step_metrics = self.micro_batch_gradients(num_tokens, padding_index, *[micro_batch[i] for micro_batch in micro_batches])
+                return (
+                    i + 1,
+                    [total + grad for total, grad in zip(grads, step_grads)],
+                    [total + metric for total, metric in zip(metrics, step_metrics)],
+                )
+
+            # The first micro-batch runs outside the loop: it builds the model on the first trace and
+            # gives the accumulators their shapes
+            grads, metrics = self.micro_batch_gradients(num_tokens, padding_index, *[micro_batch[0] for micro_batch in micro_batches])
+            _, grads, metrics = tf.while_loop(
+                lambda i, grads, metrics: i < accum_steps, accumulate, (tf.constant(1), grads, metrics),
+            )
+        if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+        return metrics
+
+    def micro_batch_gradients(self, num_tokens, padding_index, captions, image_features, segment_ids=None):
+        """
+        Forward and backward pass over one micro-batch. The summed loss is divided by num_tokens, the
+        number of predicted tokens in the whole step, so the gradients of the micro-batches add up to the
+        gradient of the mean loss.
+
+        :return: (still loss-scaled) gradients, and the batch_metrics of the micro-batch
+        """
+        decoder_input = captions[:, :-1]
+        decoder_labels = captions[:, 1:]
+        loss_scaled = isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            probs = self(image_features, decoder_input, segment_ids=input_segments(segment_ids))
+            mask = label_mask(captions, padding_index, segment_ids)
+            loss = self.loss_function(probs, decoder_labels, mask)
+            mean_loss = loss / num_tokens
+            # float16 gradients underflow without loss scaling; bfloat16 has the float32 range and needs none
+            scaled_loss = self.optimizer.get_scaled_loss(mean_loss) if loss_scaled else mean_loss
+        grads = tape.gradient(scaled_loss, self.trainable_variables)
+        # Dense accumulators: embedding gradients come back as IndexedSlices
+        grads = [tf.convert_to_tensor(grad) for grad in grads]
+        return grads, list(self.batch_metrics(probs, decoder_labels, mask, loss))
+
+    def eval_batch(self, captions, image_features, segment_ids=None, padding_index=0):
+        """
+        Forward pass only, same inputs and outputs as train_batch.
+        """
+        decoder_input = captions[:, :-1]
+        decoder_labels = captions[:, 1:]
+        probs = self(image_features, decoder_input, segment_ids=input_segments(segment_ids))
+        mask = label_mask(captions, padding_index, segment_ids)
+        loss = self.loss_function(probs, decoder_labels, mask)
+        return self.batch_metrics(probs, decoder_labels, mask, loss)
+
+    def batch_metrics(self, probs, decoder_labels, mask, loss):
+        num_predictions = tf.reduce_sum(tf.cast(mask, tf.float32))
+        accuracy = self.accuracy_function(probs, decoder_labels, mask)
+        return loss, num_predictions, num_predictions * accuracy
+
+    def train(self, dataset, padding_index, log_every=50, start_batch=0, on_batch=None):
         """
         Runs through one epoch - all training examples.
 
-        :param model: the initialized model to use for forward and backward pass
-        :param train_captions: train data captions (all data for training) 
-        :param train_images: train image features (all data for training) 
+        :param dataset: batched (captions, image_features[, segment_ids]) training data, e.g. from model.dataset.batch_pairs,
+            or distributed with model.dataset.distribute_pairs when the model was built under a strategy
         :param padding_index: the padding index, the id of *PAD* token. This integer is used when masking padding labels.
-        :return: None
+        :param log_every: metrics are read back from the device and printed every log_every batches
+        :param start_batch: batches of the epoch already trained on, when resuming an epoch from a checkpoint.
+            dataset has to start after them; the running metrics are kept instead of reset.
+        :param on_batch: called with the batch index after every optimizer step, e.g. to checkpoint
+        :return: average loss, accuracy and perplexity of the epoch
         """
-        
-        indices = tf.range(len(train_captions))
-        shuffled_indices = tf.random.shuffle(indices)
-        shuffled_captions = tf.gather(train_captions, shuffled_indices)
-        shuffled_image_features = tf.gather(train_image_features, shuffled_indices)
-
-        num_batches = int(len(train_captions) / batch_size)
-        total_loss = total_seen = total_correct = 0
-        
-        # print("shuffled stuff")
-
-        for index, end in enumerate(range(batch_size, len(train_captions)+1, batch_size)):
-            start = end - batch_size
-            batch_image_features = shuffled_image_features[start:end, :]
-            decoder_input = shuffled_captions[start:end, :-1]
-            decoder_labels = shuffled_captions[start:end, 1:]
-
-            # print("got labels")
-            padding_index = 0
-  
-            with tf.GradientTape() as tape:
-                probs = self(batch_image_features, decoder_input)
-                # print("got probs")
-                # mask = decoder_labels != padding_index
-                mask = tf.where(decoder_labels != 0, 1, 0)
-                # print("got mask")  
-                # print(decoder_labels.numpy())
-                # print("mask shape:", np.shape(decoder_labels), np.shape(padding_index))
-                # print("actual mask shape:", np.shape(mask))
-                num_predictions = tf.reduce_sum(tf.cast(mask, tf.float32))
-                # print("got num_predictions")
-                loss = self.loss_function(probs, decoder_labels, mask)
-                # print("got loss")
-                # print(np.shape(probs), np.shape(decoder_labels), np.shape(mask))
-                accuracy = self.accuracy_function(probs, decoder_labels, mask)
-                # print("got accuracy")
-                
-            # print("got grads")
-            grads = tape.gradient(loss, self.trainable_variables)
-            self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
-            # print("applied grads")
-            
-            total_loss += loss
-            total_seen += num_predictions
-            total_correct += num_predictions * accuracy
-
-            avg_loss = float(total_loss / total_seen)
-            avg_acc = float(total_correct / total_seen)
-            avg_prp = np.exp(avg_loss)
-            print(f"\r[Valid {index+1}/{num_batches}]\t loss={avg_loss:.3f}\t acc: {avg_acc:.3f}\t perp: {avg_prp:.3f}", end='')
-
-        return avg_loss, avg_acc, avg_prp
-
-    def test(self, test_captions, test_image_features, padding_index, batch_size=30):
+        return self.run_epoch(AccompanimentModel.train_batch, "Train", dataset, padding_index, log_every, start_batch, on_batch)
+
+    def test(self, dataset, padding_index, log_every=50):
         """
-        :param model: the initilized model to use for forward and backward pass
-        :param test_captions: test caption data (all data for testing) of shape (num captions,20)
-        :param test_image_features: test image feature data (all data for testing) of shape (num captions,1000)
+        :param dataset: batched (captions, image_features[, segment_ids]) test data, e.g. from model.dataset.batch_pairs
         :param padding_index: the padding index, the id of *PAD* token. This integer is used to mask padding labels.
+        :param log_every: metrics are read back from the device and printed every log_every batches
         :returns: perplexity of the test set, per symbol accuracy on test set
         """
-        num_batches = int(len(test_captions) / batch_size)
-
-        total_loss = total_seen = total_correct = 0
-        for index, end in enumerate(range(batch_size, len(test_captions)+1, batch_size)):
-
-            # Get the current batch of data, making sure to try to predict the next word
-            start = end - batch_size
-            batch_image_features = test_image_features[start:end, :]
-            decoder_input = test_captions[start:end, :-1]
-            decoder_labels = test_captions[start:end, 1:]
+        avg_loss, avg_acc, avg_prp = self.run_epoch(AccompanimentModel.eval_batch, "Valid", dataset, padding_index, log_every)
+        return avg_prp, avg_acc
 
-            # no-training forward pass
-            probs = self(batch_image_features, decoder_input)
-            mask = decoder_labels != padding_index
-            num_predictions = tf.reduce_sum(tf.cast(mask, tf.float32))
-            loss = self.loss_function(probs, decoder_labels, mask)
-            accuracy = self.accuracy_function(probs, decoder_labels, mask)
+    def run_epoch(self, step, name, dataset, padding_index, log_every, start_batch=0, on_batch=None):
+        """
+        Runs step over every batch. Metrics accumulate on the device; the host only syncs to print
+        every log_every batches and at the end of the epoch.
+        """
+        num_batches = num_batches_of(dataset)
+        if num_batches != "?":
+            num_batches += start_batch
+        metrics = step_metrics(self, step)
+        if not start_batch:
+            metrics.reset()
 
-            # get aggregated
-            total_loss += loss
-            total_seen += num_predictions
-            total_correct += num_predictions * accuracy
+        def log(index):
+            avg_loss, avg_acc, avg_prp = metrics.result()
+            print(f"\r[{name} {index+1}/{num_batches}]\t loss={avg_loss:.3f}\t acc: {avg_acc:.3f}\t perp: {avg_prp:.3f}", end='')
 
-            avg_loss = float(total_loss / total_seen)
-            avg_acc = float(total_correct / total_seen)
-            avg_prp = np.exp(avg_loss)
-            print(f"\r[Valid {index+1}/{num_batches}]\t loss={avg_loss:.3f}\t acc: {avg_acc:.3f}\t perp: {avg_prp:.3f}", end='')
+        index = start_batch - 1
+        for index, batch in enumerate(dataset, start_batch):
+            compiled_step(self, step, padding_index, dataset.element_spec)(*batch)
+            if on_batch is not None:
+                on_batch(index)
+            if log_every and (index + 1) % log_every == 0:
+                log(index)
 
-        print()        
-        return avg_prp, avg_acc
+        log(index)
+        print()
+        return metrics.result()
     
     def get_config(self):
         base_config = super().get_config()
@@ -138,6 +215,13 @@ class AccompanimentModel(tf.keras.Model):
         }
         return {**base_config, **config}
 
+    def get_build_config(self):
+        # Built like TransformerDecoder: with a dummy call, so a saved model loads with its weights
+        return self.decoder.get_build_config()
+
+    def build_from_config(self, config):
+        self(tf.zeros([1, config["melody_length"]], tf.int32), tf.zeros([1, 1], tf.int32))
+
     @classmethod
     def from_config(cls, config):
         decoder_config = config.pop("decoder")
@@ -145,6 +229,70 @@ class AccompanimentModel(tf.keras.Model):
         return cls(decoder, **config)
 
 
+def compiled_step(model, step, padding_index, signature):
+    """
+    step (AccompanimentModel.train_batch or eval_batch) compiled for this model with a fixed input
+    signature, normally the element_spec of the dataset, so a whole epoch runs on one trace. Honors the
+    jit_compile setting of model.compile.
+
+    The step runs on every replica of the strategy the model was built under (a no-op wrapper for a
+    single process). Gradients are all-reduced by the optimizer; the loss and counts are summed across
+    replicas and added to step_metrics(model, step).
+    """
+    key = (step.__name__, padding_index, signature)
+    steps = _compiled_steps.setdefault(model, {})
+    if key not in steps:
+        strategy = model.distribute_strategy
+        metrics = step_metrics(model, step)
+        replica_step = functools.partial(step, model, padding_index=padding_index)
+
+        def run_step(*batch):
+            results = strategy.run(replica_step, args=batch)
+            results = [strategy.reduce(tf.distribute.ReduceOp.SUM, result, axis=None) for result in results]
+            metrics.update(*results)
+            return results
+
+        steps[key] = tf.function(run_step, input_signature=signature, jit_compile=getattr(model, 'jit_compile', False))
+    return steps[key]
+
+
+def label_mask(captions, padding_index, segment_ids=None):
+    '''
+    Which labels (captions[:, 1:]) are predicted: no padding, and in packed rows no label whose input token
+    ends the previous segment
+    '''
+    mask = captions[:, 1:] != padding_index
+    if segment_ids is not None:
+        mask = tf.logical_and(mask, tf.equal(segment_ids[:, 1:], segment_ids[:, :-1]))
+    return mask
+
+
+def input_segments(segment_ids):
+    '''Segment ids of the decoder input (captions[:, :-1]), None for rows that are not packed'''
+    return None if segment_ids is None else segment_ids[:, :-1]
+
+
+def split_micro_batches(batch, accum_steps):
+    '''[BATCH_SIZE x ...] -> [accum_steps x BATCH_SIZE / accum_steps x ...]'''
+    return tf.reshape(batch, tf.concat([[accum_steps, -1], tf.shape(batch)[1:]], axis=0))
+
+
+def step_metrics(model, step):
+    '''The StreamingMetrics the compiled step adds to'''
+    metrics = _step_metrics.setdefault(model, {})
+    if step.__name__ not in metrics:
+        metrics[step.__name__] = StreamingMetrics()
+    return metrics[step.__name__]
+
+
+def num_batches_of(dataset):
+    '''Number of batches for the progress line, "?" when tf.data cannot tell (e.g. after a filter)'''
+    # A property on distributed datasets, a method on tf.data.Dataset
+    cardinality = dataset.cardinality
+    cardinality = int(cardinality() if callable(cardinality) else cardinality)
+    return cardinality if cardinality >= 0 else "?"
+
+
 def accuracy_function(prbs, labels, mask):
     """
     Computes the batch accuracy
@@ -152,10 +300,13 @@ def accuracy_function(prbs, labels, mask):
     :param prbs:  float tensor, word prediction probabilities [BATCH_SIZE x WINDOW_SIZE x VOCAB_SIZE]
     :param labels:  integer tensor, word prediction labels [BATCH_SIZE x WINDOW_SIZE]
     :param mask:  tensor that acts as a padding mask [BATCH_SIZE x WINDOW_SIZE]
-    :return: scalar tensor of accuracy of the batch between 0 and 1
+    :return: scalar tensor of accuracy of the batch between 0 and 1, 0 for a batch without labels
     """
-    correct_classes = tf.argmax(tf.cast(prbs, dtype=tf.int64), axis=-1) == tf.cast(labels, dtype=tf.int64)
-    accuracy = tf.reduce_mean(tf.boolean_mask(tf.cast(correct_classes, tf.float32), mask))
+    correct_classes = tf.argmax(prbs, axis=-1) == tf.cast(labels, dtype=tf.int64)
+    # Weighted by the mask instead of tf.boolean_mask, so shapes stay static
+    mask = tf.cast(mask, tf.float32)
+    # A micro-batch of padding only (packing, accumulation) would otherwise give NaN and poison the running sums
+    accuracy = tf.math.divide_no_nan(tf.reduce_sum(tf.cast(correct_classes, tf.float32) * mask), tf.reduce_sum(mask))
     return accuracy
 
 
@@ -168,8 +319,7 @@ def loss_function(prbs, labels, mask):
     :param mask:  tensor that acts as a padding mask [batch_size x window_size]
     :return: the loss of the model as a tensor
     """
-    masked_labs = tf.boolean_mask(labels, mask)
-    masked_prbs = tf.boolean_mask(prbs, mask)
-    scce = tf.keras.losses.sparse_categorical_crossentropy(masked_labs, masked_prbs, from_logits=True)
-    loss = tf.reduce_sum(scce)
+    # Padded positions are zeroed out instead of dropped with tf.boolean_mask, so shapes stay static
+    scce = tf.keras.losses.sparse_categorical_crossentropy(labels, prbs, from_logits=True)
+    loss = tf.reduce_sum(scce * tf.cast(mask, scce.dtype))
     return loss
\ No newline at end of file
@@ -3,7 +3,86 @@ import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
-tf.compat.v1.disable_eager_execution()
+
+_causal_masks = {}
+
+
+def causal_mask(num_queries, num_keys):
+    """
+    Additive causal mask for queries that are the last num_queries positions of the key window: query i
+    may only see keys up to position (num_keys - num_queries + i). Broadcasts against the attention scores.
+
+    Static sizes are built once per (num_queries, num_keys) and shared by every layer and call, created
+    outside of any tf.function graph, so mask construction never shows up in a step. Sizes only known at
+    run time (the growing cache of incremental decoding) get a cheap range comparison instead.
+
+    Hidden keys get the same large finite value as padding_mask rather than -inf, which full-integer
+    TFLite export (export_tflite.py) cannot give an activation scale.
+
+    :return: tensor of [num_queries x num_keys], 0 where visible and -1e9 elsewhere
+    """
+    if isinstance(num_queries, int) and isinstance(num_keys, int):
+        key = (num_queries, num_keys)
+        if key not in _causal_masks:
+            with tf.init_scope():
+                mask_vals = np.triu(np.full(key, -1e9), k=1 + num_keys - num_queries)
+                _causal_masks[key] = tf.constant(mask_vals, dtype=tf.float32)
+        return _causal_masks[key]
+    query_positions = tf.range(num_queries) + num_keys - num_queries
+    visible = tf.range(num_keys)[tf.newaxis, :] <= query_positions[:, tf.newaxis]
+    return tf.where(visible, 0.0, -1e9)
+
+
+def padding_mask(key_padding_mask):
+    """
+    Additive mask that hides padded keys. Uses a large finite value instead of -inf so a query that only
+    sees padding (a leading pad position) gets a uniform distribution rather than NaNs.
+
+    :param key_padding_mask: bool tensor of [batch_size x num_keys], True for real tokens
+    :return: tensor of [batch_size x 1 x num_keys]
+    """
+    return tf.where(key_padding_mask, 0.0, -1e9)[:, tf.newaxis, :]
+
+
+def attention_bias(attention_mask):
+    """
+    Additive version of a general attention mask, with the same finite value as padding_mask.
+
+    :param attention_mask: bool tensor of [batch_size x num_queries x num_keys], True where visible
+    :return: float tensor of the same shape
+    """
+    return tf.where(attention_mask, 0.0, -1e9)
+
+
+def same_segment(query_segments, key_segments):
+    """
+    Attention mask of packed rows: a query only sees keys of its own segment, which makes the (causal)
+    attention block-diagonal.
+
+    :param query_segments: segment ids [batch_size x num_queries]
+    :param key_segments: segment ids [batch_size x num_keys], or [1 x num_keys] to share it across the batch
+    :return: bool tensor of [batch_size x num_queries x num_keys]
+    """
+    return tf.equal(query_segments[:, :, tf.newaxis], key_segments[:, tf.newaxis, :])
+
+
+def segment_positions(segment_ids, num_segments):
+    """
+    Position of every token within its own segment, so positional encodings restart at 0 for every
+    segment of a packed row. Segments are contiguous; padding (segment 0) gets positions too, which no
+    prediction depends on.
+
+    :param segment_ids: [batch_size x window_size], 1..num_segments for tokens and 0 for padding
+    :return: int32 tensor of [batch_size x window_size]
+    """
+    one_hot = tf.one_hot(segment_ids, num_segments + 1, dtype=tf.int32)
+    # Number of earlier tokens of the same segment
+    return tf.reduce_sum(tf.cumsum(one_hot, axis=1, exclusive=True) * one_hot, axis=-1)
+
+
+def static_size(tensor, axis):
+    '''Python int when the size is known while tracing, otherwise the run-time size'''
+    return tensor.shape[axis] if tensor.shape[axis] is not None else tf.shape(input=tensor)[axis]
 
 
 class AttentionMatrix(tf.keras.layers.Layer):
@@ -12,36 +91,29 @@ class AttentionMatrix(tf.keras.layers.Layer):
         super().__init__(*args, **kwargs)
         self.use_mask = use_mask
 
-    def call(self, inputs):
+    def call(self, inputs, key_padding_mask=None, attention_mask=None):
         """
+        The queries are taken to be the last positions of the key window, which is what the causal mask
+        assumes; for full-window attention that is every position.
+
         :param K: is [batch_size x window_size_keys x embedding_size]
         :param Q: is [batch_size x window_size_queries x embedding_size]
+        :param key_padding_mask: optional bool [batch_size x window_size_keys], True for real tokens
+        :param attention_mask: optional bool [batch_size x window_size_queries x window_size_keys], True where
+            visible, e.g. same_segment for packed rows
         :return: attention matrix
         """
-        # print("I'm here!")
         K, Q = inputs
-        window_size_queries = Q.get_shape()[1]  # window size of queries
-        window_size_keys    = K.get_shape()[1]  # window size of keys
-        # print("I'm here2!")
-        # print("input shape:", np.shape(K), np.shape(Q))
-        # print("query size n window size", window_size_queries, window_size_keys)
-
-        mask_vals = np.triu(np.ones((window_size_queries, window_size_keys)) * np.NINF, k=1)
-        # print("I'm here3!")
-        # print(np.shape(mask_vals))
-        mask = tf.convert_to_tensor(value=mask_vals, dtype=tf.float32)
-        # print("I'm here4!")
-        atten_mask = tf.tile(tf.reshape(mask, [-1, window_size_queries, window_size_keys]), [tf.shape(input=K)[0], 1, 1])
-        # print("I'm here5!")
-
-        atten_score = tf.matmul(Q, K, transpose_b=True) 
-        # print("atten score, atten mask")
-        # print(np.shape(atten_score), np.shape(atten_mask))
+        # Masking and softmax stay in float32 under a mixed precision policy
+        atten_score = tf.cast(tf.matmul(Q, K, transpose_b=True), tf.float32)
         if self.use_mask == True:
-            atten_score += atten_mask
+            atten_score += causal_mask(static_size(Q, 1), static_size(K, 1))
+        if key_padding_mask is not None:
+            atten_score += padding_mask(key_padding_mask)
+        if attention_mask is not None:
+            atten_score += attention_bias(attention_mask)
         attention_weights = tf.nn.softmax(atten_score / np.sqrt(K.get_shape()[2]), axis=-1) #window_size_keys
-        # print("I'm here6!")
-        return attention_weights
+        return tf.cast(attention_weights, K.dtype)
 
 
 class AttentionHead(tf.keras.layers.Layer):
@@ -54,12 +126,14 @@ class AttentionHead(tf.keras.layers.Layer):
         self.attn_mtx = AttentionMatrix(use_mask=self.use_mask)
 
 
-    @tf.function
-    def call(self, inputs_for_keys, inputs_for_values, inputs_for_queries):
+    def call(self, inputs_for_keys, inputs_for_values, inputs_for_queries, key_padding_mask=None, attention_mask=None, self_attention=False):
         """
         :param inputs_for_keys: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
         :param inputs_for_values: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
         :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ]
+        :param key_padding_mask: optional bool [batch_size x KEY_WINDOW_SIZE], True for real tokens
+        :param attention_mask: optional bool [batch_size x QUERY_WINDOW_SIZE x KEY_WINDOW_SIZE], True where visible
+        :param self_attention: True when keys, values and queries are the same inputs; only FusedMultiHeadedAttention uses it
         :return: tensor of [BATCH_SIZE x QUERY_WINDOW_SIZE x output_size ]
         """
         # print("I'm here!")
@@ -69,80 +143,317 @@ class AttentionHead(tf.keras.layers.Layer):
         Q = tf.tensordot(inputs_for_queries, self.Q, axes = 1)
         # print("I'm here 2!")
 
+        attn_matrix = self.attn_mtx([K, Q], key_padding_mask=key_padding_mask, attention_mask=attention_mask)
+        return tf.matmul(attn_matrix, V)
+
+    def init_cache(self, batch_size):
+        """
+        :param batch_size: number of sequences decoded together
+        :return: empty (keys, values) cache, each of [batch_size x 0 x output_size ]
+        """
+        empty = tf.zeros([batch_size, 0, self.K.shape[-1]], dtype=self.compute_dtype)
+        return empty, empty
+
+    def project_kv(self, inputs_for_keys, inputs_for_values):
+        """
+        :return: projected (keys, values), each [batch_size x KEY_WINDOW_SIZE x output_size ]
+        """
+        # Called outside of __call__, so the weights are not autocast to the compute dtype for us
+        K = tf.tensordot(inputs_for_keys, tf.cast(self.K, self.compute_dtype), axes = 1)
+        V = tf.tensordot(inputs_for_values, tf.cast(self.V, self.compute_dtype), axes = 1)
+        return K, V
+
+    def attend(self, projected_kv, inputs_for_queries):
+        """
+        Attention against keys/values that were already projected with project_kv. The queries are taken
+        to be the last positions of the key window, which is what the causal mask assumes.
+
+        :param projected_kv: (keys, values) from project_kv
+        :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ]
+        :return: tensor of [batch_size x QUERY_WINDOW_SIZE x output_size ]
+        """
+        K, V = projected_kv
+        Q = tf.tensordot(inputs_for_queries, tf.cast(self.Q, self.compute_dtype), axes = 1)
         attn_matrix = self.attn_mtx([K, Q])
         return tf.matmul(attn_matrix, V)
 
+    def step(self, inputs, cache):
+        """
+        Incremental self-attention: only the newest positions are projected, past keys/values come from the cache.
+
+        :param inputs: tensor of [batch_size x NEW_POSITIONS x input_size ]
+        :param cache: (keys, values) of all previous positions, each [batch_size x PAST_POSITIONS x output_size ]
+        :return: tensor of [batch_size x NEW_POSITIONS x output_size ] and the extended cache
+        """
+        past_K, past_V = cache
+        new_K, new_V = self.project_kv(inputs, inputs)
+        K = tf.concat([past_K, new_K], axis=1)
+        V = tf.concat([past_V, new_V], axis=1)
+        return self.attend((K, V), inputs), (K, V)
+
 
 class MultiHeadedAttention(tf.keras.layers.Layer):
-    def __init__(self, emb_sz, use_mask, **kwargs):
+    def __init__(self, emb_sz, use_mask, num_heads=3, **kwargs):
         super(MultiHeadedAttention, self).__init__(**kwargs)
         self.emb_sz = emb_sz
         self.use_mask = use_mask
-        self.attention_head1 = AttentionHead(emb_sz, emb_sz//3, use_mask)
-        self.attention_head2 = AttentionHead(emb_sz, emb_sz//3, use_mask)
-        self.attention_head3 = AttentionHead(emb_sz, emb_sz//3, use_mask)
+        self.num_heads = num_heads
+        # attention_head1, attention_head2, ...: the names the weights of the original three heads are saved under
+        for i in range(1, num_heads + 1):
+            setattr(self, f"attention_head{i}", AttentionHead(emb_sz, emb_sz//num_heads, use_mask))
+        self.dense_res = tf.keras.layers.Dense(self.emb_sz)
+
+    def heads(self):
+        # A method rather than a property, which .keras saving would walk and save as a second copy of the heads
+        return tuple(getattr(self, f"attention_head{i}") for i in range(1, self.num_heads + 1))
+
+    def call(self, inputs_for_keys, inputs_for_values, inputs_for_queries, key_padding_mask=None, attention_mask=None, self_attention=False):
+        """
+        :param inputs_for_keys: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
+        :param inputs_for_values: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
+        :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ]
+        :param key_padding_mask: optional bool [batch_size x KEY_WINDOW_SIZE], True for real tokens
+        :param attention_mask: optional bool [batch_size x QUERY_WINDOW_SIZE x KEY_WINDOW_SIZE], True where visible
+        :param self_attention: True when keys, values and queries are the same inputs; only FusedMultiHeadedAttention uses it
+        :return: tensor of [BATCH_SIZE x QUERY_WINDOW_SIZE x output_size ]
+        """
+        results = [
+            head(inputs_for_keys, inputs_for_values, inputs_for_queries, key_padding_mask=key_padding_mask, attention_mask=attention_mask)
+            for head in self.heads()
+        ]
+        combined = tf.concat(results, axis=-1)
+        return self.dense_res(combined)
+
+    def init_cache(self, batch_size):
+        """
+        :param batch_size: number of sequences decoded together
+        :return: one empty (keys, values) cache per head
+        """
+        return tuple(head.init_cache(batch_size) for head in self.heads())
+
+    def project_kv(self, inputs_for_keys, inputs_for_values):
+        """
+        :return: one projected (keys, values) pair per head
+        """
+        return tuple(head.project_kv(inputs_for_keys, inputs_for_values) for head in self.heads())
+
+    def attend(self, projected_kv, inputs_for_queries):
+        """
+        :param projected_kv: per-head (keys, values) from project_kv
+        :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ]
+        :return: tensor of [BATCH_SIZE x QUERY_WINDOW_SIZE x output_size ]
+        """
+        results = [head.attend(kv, inputs_for_queries) for head, kv in zip(self.heads(), projected_kv)]
+        combined = tf.concat(results, axis=-1)
+        return self.dense_res(combined)
+
+    def step(self, inputs, cache):
+        """
+        :param inputs: tensor of [batch_size x NEW_POSITIONS x input_size ]
+        :param cache: per-head (keys, values) caches from init_cache or a previous step
+        :return: tensor of [batch_size x NEW_POSITIONS x output_size ] and the extended caches
+        """
+        results, caches = zip(*(head.step(inputs, head_cache) for head, head_cache in zip(self.heads(), cache)))
+        combined = tf.concat(results, axis=-1)
+        return self.dense_res(combined), caches
+
+
+class FusedMultiHeadedAttention(tf.keras.layers.Layer):
+    """
+    Multi-headed attention with any number of heads, one packed QKV weight and all heads computed together
+    with batched einsums instead of one AttentionHead layer per head. Keys/values keep time on axis 1
+    ([batch_size x WINDOW_SIZE x num_heads x head_size]) so the caches work like the per-head ones.
+    """
+
+    def __init__(self, emb_sz, use_mask, num_heads=3, **kwargs):
+        super(FusedMultiHeadedAttention, self).__init__(**kwargs)
+        self.emb_sz = emb_sz
+        self.use_mask = use_mask
+        self.num_heads = num_heads
+        self.head_size = emb_sz // num_heads
+        self.qkv = self.add_weight(name = "qkv", shape=[emb_sz, 3, num_heads, self.head_size])
         self.dense_res = tf.keras.layers.Dense(self.emb_sz)
-        
 
-    @tf.function
-    def call(self, inputs_for_keys, inputs_for_values, inputs_for_queries):
+    def call(self, inputs_for_keys, inputs_for_values, inputs_for_queries, key_padding_mask=None, attention_mask=None, self_attention=False):
         """
         :param inputs_for_keys: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
         :param inputs_for_values: tensor of [batch_size x KEY_WINDOW_SIZE x input_size ]
         :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ]
+        :param key_padding_mask: optional bool [batch_size x KEY_WINDOW_SIZE], True for real tokens
+        :param attention_mask: optional bool [batch_size x QUERY_WINDOW_SIZE x KEY_WINDOW_SIZE], True where visible
+        :param self_attention: True when keys, values and queries are the same inputs, which are then projected together
+        :return: tensor of [BATCH_SIZE x QUERY_WINDOW_SIZE x output_size ]
+        """
+        if self_attention:
+            # Self-attention: Q, K and V all come out of a single projection
+            Q, K, V = tf.unstack(tf.einsum('bte,ecnh->cbtnh', inputs_for_queries, self.compute_qkv()), axis=0)
+            return self.attend_heads(Q, K, V, key_padding_mask, attention_mask)
+        return self.attend(self.project_kv(inputs_for_keys, inputs_for_values), inputs_for_queries, key_padding_mask, attention_mask)
+
+    def init_cache(self, batch_size):
+        """
+        :param batch_size: number of sequences decoded together
+        :return: empty (keys, values) cache, each of [batch_size x 0 x num_heads x head_size]
+        """
+        empty = tf.zeros([batch_size, 0, self.num_heads, self.head_size], dtype=self.compute_dtype)
+        return empty, empty
+
+    def project_kv(self, inputs_for_keys, inputs_for_values):
+        """
+        :return: projected (keys, values), each [batch_size x KEY_WINDOW_SIZE x num_heads x head_size]
+        """
+        qkv = self.compute_qkv()
+        if inputs_for_keys is inputs_for_values:
+            K, V = tf.unstack(tf.einsum('bte,ecnh->cbtnh', inputs_for_keys, qkv[:, 1:]), axis=0)
+            return K, V
+        K = tf.einsum('bte,enh->btnh', inputs_for_keys, qkv[:, 1])
+        V = tf.einsum('bte,enh->btnh', inputs_for_values, qkv[:, 2])
+        return K, V
+
+    def attend(self, projected_kv, inputs_for_queries, key_padding_mask=None, attention_mask=None):
+        """
+        :param projected_kv: (keys, values) from project_kv
+        :param inputs_for_queries: tensor of [batch_size x QUERY_WINDOW_SIZE x input_size ], the last positions of the key window
+        :param key_padding_mask: optional bool [batch_size x KEY_WINDOW_SIZE], True for real tokens
+        :param attention_mask: optional bool [batch_size x QUERY_WINDOW_SIZE x KEY_WINDOW_SIZE], True where visible
         :return: tensor of [BATCH_SIZE x QUERY_WINDOW_SIZE x output_size ]
         """
-        k1, v1, q1 = inputs_for_keys, inputs_for_values, inputs_for_queries 
-        k2, v2, q2 = inputs_for_keys, inputs_for_values, inputs_for_queries  
-        k3, v3, q3 = inputs_for_keys, inputs_for_values, inputs_for_queries  
-        res1 = self.attention_head1(k1, v1, q1)
-        res2 = self.attention_head2(k2, v2, q2)
-        res3 = self.attention_head3(k3, v3, q3)
-        combined = tf.concat([res1, res2, res3], axis=-1)
+        K, V = projected_kv
+        Q = tf.einsum('bte,enh->btnh', inputs_for_queries, self.compute_qkv()[:, 0])
+        return self.attend_heads(Q, K, V, key_padding_mask, attention_mask)
+
+    def step(self, inputs, cache):
+        """
+        :param inputs: tensor of [batch_size x NEW_POSITIONS x input_size ]
+        :param cache: (keys, values) from init_cache or a previous step
+        :return: tensor of [batch_size x NEW_POSITIONS x output_size ] and the extended cache
+        """
+        past_K, past_V = cache
+        Q, new_K, new_V = tf.unstack(tf.einsum('bte,ecnh->cbtnh', inputs, self.compute_qkv()), axis=0)
+        K = tf.concat([past_K, new_K], axis=1)
+        V = tf.concat([past_V, new_V], axis=1)
+        return self.attend_heads(Q, K, V), (K, V)
+
+    def compute_qkv(self):
+        '''Packed QKV weight in the compute dtype; step/attend run outside of __call__ and its autocasting'''
+        return tf.cast(self.qkv, self.compute_dtype)
+
+    def attend_heads(self, Q, K, V, key_padding_mask=None, attention_mask=None):
+        # Masking and softmax stay in float32 under a mixed precision policy
+        atten_score = tf.cast(tf.einsum('bqnh,bknh->bnqk', Q, K), tf.float32)
+        if self.use_mask == True:
+            atten_score += causal_mask(static_size(Q, 1), static_size(K, 1))
+        if key_padding_mask is not None:
+            # [batch_size x 1 x num_keys] -> [batch_size x 1 x 1 x num_keys], broadcast over heads and queries
+            atten_score += padding_mask(key_padding_mask)[:, tf.newaxis]
+        if attention_mask is not None:
+            atten_score += attention_bias(attention_mask)[:, tf.newaxis]
+        attention_weights = tf.cast(tf.nn.softmax(atten_score / np.sqrt(self.head_size), axis=-1), V.dtype)
+        combined = tf.einsum('bnqk,bknh->bqnh', attention_weights, V)
+        combined = tf.reshape(combined, tf.concat([tf.shape(input=combined)[:2], [self.num_heads * self.head_size]], axis=0))
         return self.dense_res(combined)
-        
+
+    def load_heads(self, attention):
+        """
+        Takes over the weights of a MultiHeadedAttention (e.g. from an existing checkpoint). Needs the
+        same num_heads and both layers built.
+        """
+        heads = attention.heads()
+        if self.num_heads != len(heads):
+            raise ValueError(f"Cannot load {len(heads)} attention heads into {self.num_heads}")
+        self.qkv.assign(tf.stack([tf.stack([head.Q, head.K, head.V], axis=1) for head in heads], axis=2))
+        self.dense_res.set_weights(attention.dense_res.get_weights())
 
 
 class TransformerBlock(tf.keras.layers.Layer):
-    def __init__(self, emb_sz, multiheaded=True, **kwargs):
+    def __init__(self, emb_sz, multiheaded=True, num_heads=3, fused=False, **kwargs):
         super(TransformerBlock, self).__init__(**kwargs)
 
         self.ff_layer = tf.keras.layers.Dense(emb_sz, activation='relu')
 
-        self.self_atten         = AttentionHead(emb_sz, emb_sz, True)  if not multiheaded else MultiHeadedAttention(emb_sz, True)
-        self.self_context_atten = AttentionHead(emb_sz, emb_sz, False) if not multiheaded else MultiHeadedAttention(emb_sz, False)
-        self.layer_norm1 = tf.keras.layers.LayerNormalization()
-        self.layer_norm2 = tf.keras.layers.LayerNormalization()
-        self.layer_norm3 = tf.keras.layers.LayerNormalization()
+        if fused:
+            self.self_atten         = FusedMultiHeadedAttention(emb_sz, True, num_heads)
+            self.self_context_atten = FusedMultiHeadedAttention(emb_sz, False, num_heads)
+        else:
+            self.self_atten         = AttentionHead(emb_sz, emb_sz, True)  if not multiheaded else MultiHeadedAttention(emb_sz, True, num_heads)
+            self.self_context_atten = AttentionHead(emb_sz, emb_sz, False) if not multiheaded else MultiHeadedAttention(emb_sz, False, num_heads)
+        # Layer norms always compute in float32, see norm
+        self.layer_norm1 = tf.keras.layers.LayerNormalization(dtype='float32')
+        self.layer_norm2 = tf.keras.layers.LayerNormalization(dtype='float32')
+        self.layer_norm3 = tf.keras.layers.LayerNormalization(dtype='float32')
 
-    @tf.function
-    def call(self, inputs, context_sequence):
+    def call(self, inputs, context_sequence, key_padding_mask=None, self_attention_mask=None, context_attention_mask=None):
         """
         :param inputs: tensor of shape [BATCH_SIZE x INPUT_SEQ_LENGTH x EMBEDDING_SIZE ]
         :param context_sequence: tensor of shape [BATCH_SIZE x CONTEXT_SEQ_LENGTH x EMBEDDING_SIZE ]
+        :param key_padding_mask: optional bool [BATCH_SIZE x INPUT_SEQ_LENGTH], True for real (non-pad) tokens
+        :param self_attention_mask: optional bool [BATCH_SIZE x INPUT_SEQ_LENGTH x INPUT_SEQ_LENGTH], on top of the causal mask
+        :param context_attention_mask: optional bool [BATCH_SIZE x INPUT_SEQ_LENGTH x CONTEXT_SEQ_LENGTH]
         :return: tensor of shape [BATCH_SIZE x INPUT_SEQ_LENGTH x EMBEDDING_SIZE ]
         """
         # print("calling self_atten")
         # print("shapes:", np.shape(inputs), np.shape(context_sequence))
         # print(context_sequence)
         # print(inputs)
-        masked_attn = self.self_atten(inputs, inputs, inputs)
+        masked_attn = self.self_atten(inputs, inputs, inputs, key_padding_mask=key_padding_mask, attention_mask=self_attention_mask, self_attention=True)
         # print("got masked_attn")
         masked_attn = masked_attn + inputs
         # print("got masked_attn")
-        masked_attn = self.layer_norm1(masked_attn)
+        masked_attn = self.norm(self.layer_norm1, masked_attn)
         # print("got context_sequence")
 
-        unmasked_attn = self.self_context_atten(context_sequence, context_sequence, masked_attn)
+        unmasked_attn = self.self_context_atten(context_sequence, context_sequence, masked_attn, attention_mask=context_attention_mask)
         # print("got unmasked_attn")
+        return self.feed_forward(unmasked_attn, masked_attn)
+
+    def init_cache(self, batch_size):
+        """
+        :param batch_size: number of sequences decoded together
+        :return: empty self-attention cache for step
+        """
+        return self.self_atten.init_cache(batch_size)
+
+    def project_context(self, context_sequence):
+        """
+        Context attention keys/values only depend on the context, so step takes them precomputed.
+
+        :param context_sequence: tensor of shape [BATCH_SIZE x CONTEXT_SEQ_LENGTH x EMBEDDING_SIZE ]
+        :return: projected context keys/values for step
+        """
+        return self.self_context_atten.project_kv(context_sequence, context_sequence)
+
+    def step(self, inputs, context_kv, cache):
+        """
+        Same as call, but only for the newest positions, reusing cached self-attention keys/values.
+
+        :param inputs: tensor of shape [BATCH_SIZE x NEW_POSITIONS x EMBEDDING_SIZE ]
+        :param context_kv: output of project_context
+        :param cache: self-attention cache from init_cache or a previous step
+        :return: tensor of shape [BATCH_SIZE x NEW_POSITIONS x EMBEDDING_SIZE ] and the extended cache
+        """
+        masked_attn, cache = self.self_atten.step(inputs, cache)
+        masked_attn = masked_attn + inputs
+        masked_attn = self.norm(self.layer_norm1, masked_attn)
+
+        unmasked_attn = self.self_context_atten.attend(context_kv, masked_attn)
+        return self.feed_forward(unmasked_attn, masked_attn), cache
+
+    def norm(self, layer_norm, x):
+        '''Layer norm in float32 (mean/variance are unstable in 16 bits), result back in the dtype of x'''
+        return tf.cast(layer_norm(tf.cast(x, tf.float32)), x.dtype)
+
+    def feed_forward(self, unmasked_attn, masked_attn):
+        """
+        Residual and feed forward after the context attention, position-wise.
+        """
         unmasked_attn = unmasked_attn + masked_attn
-        unmasked_attn = self.layer_norm2(unmasked_attn)
+        unmasked_attn = self.norm(self.layer_norm2, unmasked_attn)
         # print("got unmasked_attn layer norm 2")
         feed_forward = self.ff_layer(unmasked_attn)
         # print("got feed_forward")
         feed_forward = feed_forward + unmasked_attn
         # print("got feed_forward")
-        feed_forward = self.layer_norm3(feed_forward)
+        feed_forward = self.norm(self.layer_norm3, feed_forward)
         return tf.nn.relu(feed_forward)
 
 
@@ -168,9 +479,25 @@ class PositionalEncoding(tf.keras.layers.Layer):
         ## HINT: May want to use the function above...
         self.pos_encoding = positional_encoding(window_size, embed_size)
 
-    def call(self, x):
+    def call(self, x, positions=None):
+        """
+        :param x: tokens [BATCH_SIZE x WINDOW_SIZE]
+        :param positions: optional position of every token [BATCH_SIZE x WINDOW_SIZE], e.g. segment_positions
+            for packed rows; by default the window index
+        """
+        embeddings = self.embedding(x)
+        embeddings = embeddings * tf.sqrt(tf.cast(self.embed_size, dtype=embeddings.dtype))
+        pos_encoding = self.pos_encoding if positions is None else tf.gather(self.pos_encoding, positions)
+        embeddings = tf.add(embeddings, tf.cast(pos_encoding, embeddings.dtype))
+        return embeddings
+
+    def step(self, x, position):
+        """
+        :param x: newest tokens [BATCH_SIZE x NEW_POSITIONS], the first of which sits at index position of the window
+        :return: embeddings offset by the matching slice of the positional encoding
+        """
         embeddings = self.embedding(x)
-        embeddings = embeddings * tf.sqrt(tf.cast(self.embed_size, dtype=tf.float32))
-        embeddings = tf.add(embeddings, self.pos_encoding)
+        embeddings = embeddings * tf.sqrt(tf.cast(self.embed_size, dtype=embeddings.dtype))
+        embeddings = tf.add(embeddings, tf.cast(self.pos_encoding[position:position + tf.shape(x)[1]], embeddings.dtype))
         return embeddings
     
\ No newline at end of file
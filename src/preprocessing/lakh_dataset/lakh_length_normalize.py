@@ -1,8 +1,14 @@
+import os
+import sys
 import numpy as np
 from music21 import *
 import pickle
 from miditok import REMI, TokenizerConfig
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from data_preprocessing.token_filters import kind_ids, id_lookup, dedupe_bars, windows_without
+
 # 4000 datapoints for now in these pickled lists
 with open('src/data/generated/input_tokens.pkl', 'rb') as f:
     input_tokens_list = pickle.load(f)
@@ -12,48 +18,30 @@ with open('src/data/generated/tokenizer.pkl', 'rb') as f:
     tokenizer = pickle.load(f)
 
 tokenizer.vocab['Start'] = 258
+bar_ids = kind_ids(tokenizer.vocab, 'Bar')
+# Windows with drums are left out
+drum_lookup = id_lookup(kind_ids(tokenizer.vocab, 'PitchDrum'), tokenizer.vocab)
 final_input_ids = []
 final_label_ids = []
 
 # Normalize the length of the input and label lists to be the same window length, then output batches into a pickled file
 for (input, label) in zip(input_tokens_list, label_tokens_list):
     # The actual token data is in the first element
-    input_tokens = input[0]
-    label_tokens = label[0]
-    input_ids = input_tokens.ids
-    input_ids = [input_ids[i] for i in range(len(input_ids)-1) if input_ids[i] != 4 or input_ids[i] != input_ids[i+1]]
-    label_ids = label_tokens.ids
-    label_ids = [label_ids[i] for i in range(len(label_ids)-1) if label_ids[i] != 4 or label_ids[i] != label_ids[i+1]]
+    input_ids = dedupe_bars(input[0].ids, bar_ids)
+    label_ids = dedupe_bars(label[0].ids, bar_ids)
 
     min_length = min(len(input_ids), len(label_ids))
     batches = min_length // 256
     if min_length > 256:
         # Split the input and label ids into batches of 256 until they can't be split anymore
-        input_batches = [input_ids[i*256:(i+1)*256] for i in range(batches)]
-        label_batches = [label_ids[i*256:(i+1)*256] for i in range(batches)]
-        final_input_batches = []
-        final_label_batches = []
-
-        # If the id is between 5 and 92 it is a pitch, so transpose it from range(-6, 6).
-        for (input_sequence, label_sequence) in zip(input_batches, label_batches):
-            if any(id in range(197, 258) for id in input_sequence) or any(id in range(197, 258) for id in label_sequence):
-                continue
-            input_sequence = [258] + input_sequence
-            label_sequence = [258] + label_sequence
-            for j in range(-6, 6):
-                for i in range(len(input_sequence)):
-                    if 11 <= input_sequence[i] <= 87:
-                        input_sequence[i] = input_sequence[i] + j
-                final_input_batches.append(input_sequence)
-                for i in range(len(label_sequence)):
-                    if 11 <= label_sequence[i] <= 87:
-                        label_sequence[i] = label_sequence[i] + j
-                final_label_batches.append(label_sequence)
+        input_batches = input_ids[:batches * 256].reshape(batches, 256)
+        label_batches = label_ids[:batches * 256].reshape(batches, 256)
+        keep = windows_without(input_batches, drum_lookup) & windows_without(label_batches, drum_lookup)
 
         # Each element in these batches will be a single data point.
-        # Append these to the final lists
-        final_input_ids.extend(final_input_batches)
-        final_label_ids.extend(final_label_batches)
+        # Every window is stored once; transposed copies are made while training (main.py --transpose)
+        final_input_ids.extend([258] + window.tolist() for window in input_batches[keep])
+        final_label_ids.extend([258] + window.tolist() for window in label_batches[keep])
 
 
 # Save final_input_ids and final_label_ids to a pickled file
@@ -0,0 +1,239 @@
+import numpy as np
+import tensorflow as tf
+import pickle
+import symusic
+
+from model.model import AccompanimentModel
+from model.decoder import TransformerDecoder, fuse_attention
+from inference.generation import generate_stream, check_length
+from inference.context_cache import ContextCache
+from data_preprocessing.token_filters import fit_melody
+
+import argparse
+import asyncio
+import base64
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Long-lived harmonization service. The model and tokenizer are loaded once; clients talk newline-delimited JSON over TCP:
+#   {"tokens": [...]} or {"midi": "<base64 MIDI bytes>"}, optionally with "temperature" and "seed"
+#     -> one {"token": id} line per sampled token, then {"done": true, "latency_ms": ...}
+#        ({"error": ...} instead for an invalid request, or if its batch fails)
+#   {"stats": true}
+#     -> {"queue_depth": ..., "active": ..., "served": ..., "latency_ms": {...}}
+# Requests arriving within --batch_window_ms of each other are decoded together as one batch.
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Serve harmonies from a trained model.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host',               type=str,   default='127.0.0.1',                        help='Interface to listen on')
+    parser.add_argument('--port',               type=int,   default=8765,                               help='Port to listen on')
+    parser.add_argument('--chkpt_path',         default='src/saved_models/model_duet.keras',            help='Model to serve')
+    parser.add_argument('--tokenizer_path',     default='src/data_preprocessing/tokenizers/tokenizer.pkl', help='Pickled tokenizer')
+    parser.add_argument('--fused_attention',    action='store_true',        help='Convert the model to the fused multi-head attention layer')
+    parser.add_argument('--precision',          default='float32', choices=['float32', 'mixed_bfloat16'], help='Keras dtype policy to run the model in')
+    parser.add_argument('--length',             type=int,   default=None,   help="Number of harmony tokens to generate, start token included, the model's window + 1 if not given")
+    parser.add_argument('--batch_window_ms',    type=float, default=5.0,    help='How long to wait for more requests before decoding a batch')
+    parser.add_argument('--max_batch_size',     type=int,   default=64,     help='Largest number of requests decoded together')
+    parser.add_argument('--context_cache_mb',   type=float, default=256.0,  help='Memory cap of the encoded melody cache')
+    parser.add_argument('--stats_interval',     type=float, default=30.0,   help='Seconds between stats log lines, 0 to disable')
+    if args is None:
+        return parser.parse_args()
+    return parser.parse_args(args)
+
+
+def request_options(message):
+    '''Sampling temperature and seed of a request message, checked before the request joins a batch'''
+    temperature = message.get("temperature", 1.0)
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not temperature > 0:
+        raise ValueError(f"temperature must be a number > 0, got {temperature!r}")
+    seed = message.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not -2**63 <= seed < 2**63):
+        raise ValueError(f"seed must be a 64-bit integer or null, got {seed!r}")
+    return float(temperature), seed
+
+
+class HarmonyRequest:
+    def __init__(self, melody, temperature, seed):
+        self.melody = melody
+        self.temperature = temperature
+        self.seed = seed
+        self.tokens = asyncio.Queue()   # sampled ids, None once the request is finished
+        self.error = None               # why the request failed, if its batch did
+        self.arrived = time.perf_counter()
+
+
+class HarmonyServer:
+
+    def __init__(self, model, tokenizer, length, batch_window_ms=5.0, max_batch_size=64, context_cache_mb=256.0):
+        self.model = model
+        self.tokenizer = tokenizer
+        # At most one full harmony window after the start token
+        self.length = model.decoder.window_size + 1 if length is None else length
+        check_length(model.decoder.window_size, self.length)
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.melody_length = model.decoder.image_embedding.kernel.shape[0]
+        self.end_token = tokenizer.vocab.get('EOS_None')
+        self.context_cache = ContextCache(model.decoder, max_bytes=int(context_cache_mb * 2**20))
+
+        self.pending = asyncio.Queue()
+        self.active = 0
+        self.served = 0
+        self.latencies = deque(maxlen=1000)
+        # TensorFlow work stays on one thread so the event loop keeps accepting requests while a batch decodes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # MIDI parsing and tokenization too, on a thread of their own so they do not hold up the decoding steps
+        self.tokenize_executor = ThreadPoolExecutor(max_workers=1)
+
+    def melody_from_midi(self, midi_bytes):
+        '''Tokenizes MIDI bytes into a melody the way convert_single_midi.py does, any failure as a ValueError'''
+        try:
+            sequences = self.tokenizer(symusic.Score.from_midi(midi_bytes))
+        except Exception as e:
+            raise ValueError(f"Invalid MIDI file: {e}") from e
+        if not sequences:
+            raise ValueError("MIDI file has no tracks")
+        return fit_melody(sequences[0].ids, self.tokenizer.vocab, self.melody_length)
+
+    async def submit(self, melody, temperature=1.0, seed=None):
+        '''Queues a melody and returns its request, whose tokens queue is filled as the batch decodes'''
+        if len(melody) != self.melody_length:
+            raise ValueError(f"Expected {self.melody_length} melody tokens, got {len(melody)}")
+        request = HarmonyRequest(melody, temperature, seed)
+        await self.pending.put(request)
+        return request
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # A failed batch is reported to its clients (see run_batch); the loop keeps serving the next ones
+            try:
+                await self.run_batch(batch)
+            except Exception as e:
+                print(f"Batch of {len(batch)} request(s) failed: {e!r}", flush=True)
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.active = len(batch)
+        try:
+            steps = generate_stream(
+                self.model.decoder,
+                melodies      = np.array([request.melody for request in batch]),
+                temperatures  = [request.temperature for request in batch],
+                seeds         = [request.seed for request in batch],
+                length        = self.length,
+                end_token     = self.end_token,
+                context_cache = self.context_cache,
+            )
+            while True:
+                step = await loop.run_in_executor(self.executor, next, steps, None)
+                if step is None:
+                    break
+                rows, tokens = step
+                for row, token in zip(rows, tokens):
+                    batch[row].tokens.put_nowait(int(token))
+        except Exception as e:
+            for request in batch:
+                request.error = str(e)
+            raise
+        finally:
+            for request in batch:
+                request.tokens.put_nowait(None)
+                self.latencies.append(time.perf_counter() - request.arrived)
+            self.served += len(batch)
+            self.active = 0
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "queue_depth": self.pending.qsize(),
+            "active":      self.active,
+            "served":      self.served,
+            "latency_ms":  {
+                "mean": float(latencies.mean()) if len(latencies) else None,
+                "p50":  float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99":  float(np.percentile(latencies, 99)) if len(latencies) else None,
+            },
+            "context_cache": self.context_cache.stats(),
+        }
+
+    async def handle_client(self, reader, writer):
+        async def send(message):
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError("Expected a JSON object")
+                    if message.get("stats"):
+                        await send(self.stats())
+                        continue
+                    if "midi" in message:
+                        midi_bytes = base64.b64decode(message["midi"])
+                        melody = await asyncio.get_running_loop().run_in_executor(self.tokenize_executor, self.melody_from_midi, midi_bytes)
+                    else:
+                        melody = [int(token) for token in message["tokens"]]
+                    temperature, seed = request_options(message)
+                    request = await self.submit(melody, temperature, seed)
+                except (ValueError, KeyError, TypeError) as e:
+                    await send({"error": str(e)})
+                    continue
+
+                while (token := await request.tokens.get()) is not None:
+                    await send({"token": token})
+                if request.error is not None:
+                    await send({"error": request.error})
+                    continue
+                await send({"done": True, "latency_ms": (time.perf_counter() - request.arrived) * 1000})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def log_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps(self.stats()), flush=True)
+
+
+async def serve(args):
+    with open(args.tokenizer_path, 'rb') as f:
+        tokenizer = pickle.load(f)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    model = tf.keras.models.load_model(
+        args.chkpt_path,
+        custom_objects=dict(
+            TransformerDecoder  = TransformerDecoder,
+            AccompanimentModel  = AccompanimentModel,
+        ),
+    )
+    if args.fused_attention:
+        model.decoder = fuse_attention(model.decoder)
+    print(f"Model loaded from '{args.chkpt_path}'")
+
+    harmony_server = HarmonyServer(model, tokenizer, args.length, args.batch_window_ms, args.max_batch_size, args.context_cache_mb)
+    tasks = [asyncio.create_task(harmony_server.batch_loop())]
+    if args.stats_interval > 0:
+        tasks.append(asyncio.create_task(harmony_server.log_stats(args.stats_interval)))
+
+    server = await asyncio.start_server(harmony_server.handle_client, args.host, args.port)
+    print(f"Serving harmonies on {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(parse_args()))
@@ -0,0 +1,415 @@
+import numpy as np
+import tensorflow as tf
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import functools
+import argparse
+import subprocess
+
+# Run from the root directory like the other scripts: python src/testing/benchmark.py <benchmark>
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model.model import AccompanimentModel, compiled_step, accuracy_function, loss_function
+from model.decoder import TransformerDecoder
+from inference.generation import generate, generate_stream
+from inference.speculative import speculative_generate
+from data_preprocessing.token_filters import kind_ids, pitch_ids, id_lookup, dedupe_bars, drop_notes, windows_without
+from miditok import REMI, TokenizerConfig
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for training and generation.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    speculative = subparsers.add_parser('speculative', help='Speculative decoding against plain sampling', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    speculative.add_argument('--chkpt_path',    default=None,   help='Trained model to verify with, random weights if not given')
+    speculative.add_argument('--draft_path',    default=None,   help='Trained draft model, random weights if not given')
+    speculative.add_argument('--hidden_size',   type=int,   default=512,    help='Hidden size of the random-weight model')
+    speculative.add_argument('--draft_hidden',  type=int,   default=128,    help='Hidden size of the random-weight draft')
+    speculative.add_argument('--num_draft',     type=int,   default=4,      help='Tokens proposed per verification pass')
+    speculative.add_argument('--length',        type=int,   default=63,     help='Tokens to generate per sample, start token included')
+    speculative.add_argument('--samples',       type=int,   default=10,     help='Number of melodies to harmonize')
+    speculative.add_argument('--temperature',   type=float, default=1.0,    help='Sampling temperature')
+
+    train_step = subparsers.add_parser('train_step', help='Compiled train step against the eager loop', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    train_step.add_argument('--hidden_size',    type=int,   default=512,    help='Hidden size of the model')
+    train_step.add_argument('--batch_size',     type=int,   default=50,     help='Batch size')
+    train_step.add_argument('--steps',          type=int,   default=20,     help='Timed steps per mode')
+    train_step.add_argument('--modes',          nargs='+',  default=['eager', 'compiled', 'xla'], choices=['eager', 'compiled', 'xla'], help='Step variants to time')
+
+    precision = subparsers.add_parser('precision', help='Step time and perplexity of mixed precision against float32', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    precision.add_argument('--hidden_size',     type=int,   default=512,    help='Hidden size of the model')
+    precision.add_argument('--batch_size',      type=int,   default=50,     help='Batch size')
+    precision.add_argument('--steps',           type=int,   default=100,    help='Training steps per policy')
+    precision.add_argument('--policies',        nargs='+',  default=['float32', 'mixed_bfloat16'], choices=['float32', 'mixed_bfloat16', 'mixed_float16'], help='Keras dtype policies to compare')
+
+    suite = subparsers.add_parser('suite', help='Training/eval tokens/sec, generation latency and peak memory as JSON, on synthetic data', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    suite.add_argument('--hidden_sizes',        type=int,   nargs='+',  default=[128, 512], help='Model sizes to benchmark')
+    suite.add_argument('--num_heads',           type=int,   default=3,      help='Attention heads (any number with --fused_attention, otherwise 3)')
+    suite.add_argument('--fused_attention',     action='store_true',        help='Use the fused multi-head attention layer')
+    suite.add_argument('--precision',           default='float32', choices=['float32', 'mixed_bfloat16'], help='Keras dtype policy')
+    suite.add_argument('--jit_compile',         action='store_true',        help='Compile the train/eval steps with XLA')
+    suite.add_argument('--batch_size',          type=int,   default=50,     help='Training and eval batch size')
+    suite.add_argument('--train_steps',         type=int,   default=20,     help='Timed training steps')
+    suite.add_argument('--eval_steps',          type=int,   default=20,     help='Timed eval steps')
+    suite.add_argument('--gen_batch',           type=int,   default=1,      help='Melodies generated together')
+    suite.add_argument('--gen_samples',         type=int,   default=5,      help='Timed generation runs')
+    suite.add_argument('--gen_length',          type=int,   default=63,     help='Tokens per generated harmony, start token included')
+    suite.add_argument('--output',              default=None,               help='JSON file the results are written to (printed either way)')
+    suite.add_argument('--baseline',            default=None,               help='Earlier --output to compare against')
+
+    filters = subparsers.add_parser('filters', help='Vectorized token filters against the loops of the preprocessing scripts', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    filters.add_argument('--num_files',         type=int,   default=20,     help='Synthetic tokenized files')
+    filters.add_argument('--notes',             type=int,   default=5000,   help='Notes per file')
+    filters.add_argument('--window_size',       type=int,   default=256,    help='Window size of the rejection filter')
+
+    if args is None:
+        return parser.parse_args()
+    return parser.parse_args(args)
+
+
+def load_decoder(chkpt_path, hidden_size, vocab_size=290, window_size=63):
+    '''Decoder of a saved AccompanimentModel, or a randomly initialized one when there is no checkpoint'''
+    if chkpt_path is None:
+        return TransformerDecoder(vocab_size=vocab_size, hidden_size=hidden_size, window_size=window_size)
+    model = tf.keras.models.load_model(
+        chkpt_path,
+        custom_objects=dict(
+            TransformerDecoder  = TransformerDecoder,
+            AccompanimentModel  = AccompanimentModel,
+        ),
+    )
+    return model.decoder
+
+
+def random_melodies(num_melodies, vocab_size=290, melody_length=64, seed=0):
+    return np.random.default_rng(seed).integers(1, vocab_size, size=(num_melodies, melody_length))
+
+
+def random_batch(batch_size, vocab_size=290, window_size=63, melody_length=64, seed=0):
+    '''Synthetic (captions, image_features) batch shaped like the training data'''
+    rng = np.random.default_rng(seed)
+    captions = rng.integers(1, vocab_size, size=(batch_size, window_size + 1), dtype=np.int32)
+    image_features = rng.integers(1, vocab_size, size=(batch_size, melody_length), dtype=np.int32)
+    return tf.constant(captions), tf.constant(image_features)
+
+
+def batch_spec(captions, image_features):
+    '''Input signature of the compiled steps for batches like these, as dataset.element_spec would give'''
+    return tf.TensorSpec.from_tensor(captions), tf.TensorSpec.from_tensor(image_features)
+
+
+def benchmark_train_step(args):
+    captions, image_features = random_batch(args.batch_size)
+    for mode in args.modes:
+        model = AccompanimentModel(TransformerDecoder(vocab_size=290, hidden_size=args.hidden_size, window_size=63))
+        model.compile(tf.keras.optimizers.Adam(1e-3), loss_function, [accuracy_function], jit_compile=mode == 'xla')
+        if mode == 'eager':
+            # The loop before compiled steps: an eager tape around a tf.function forward pass
+            model.call = tf.function(model.call)
+            step = functools.partial(model.train_batch, padding_index=0)
+        else:
+            step = compiled_step(model, AccompanimentModel.train_batch, 0, batch_spec(captions, image_features))
+
+        start = time.perf_counter()
+        float(step(captions, image_features)[0])
+        first_step = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            loss = step(captions, image_features)[0]
+        float(loss)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:9s} {args.steps / elapsed:7.2f} steps/s ({elapsed / args.steps * 1000:.1f} ms/step, first step {first_step:.2f}s)")
+
+
+def pattern_batch(batch_size, vocab_size=290, window_size=63, melody_length=64, seed=0):
+    '''Synthetic batch whose captions are arithmetic progressions of ids, so a model can actually learn them'''
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, vocab_size - 5, size=(batch_size, 1))
+    strides = rng.integers(1, 6, size=(batch_size, 1))
+    captions = 5 + (starts + strides * np.arange(window_size + 1)) % (vocab_size - 5)
+    image_features = rng.integers(1, vocab_size, size=(batch_size, melody_length))
+    return tf.constant(captions, dtype=tf.int32), tf.constant(image_features, dtype=tf.int32)
+
+
+def benchmark_precision(args):
+    batches = [pattern_batch(args.batch_size, seed=i) for i in range(8)]
+    valid = pattern_batch(args.batch_size, seed=len(batches))
+    for policy in args.policies:
+        tf.keras.mixed_precision.set_global_policy(policy)
+        tf.random.set_seed(0)
+        model = AccompanimentModel(TransformerDecoder(vocab_size=290, hidden_size=args.hidden_size, window_size=63))
+        optimizer = tf.keras.optimizers.Adam(1e-3)
+        if policy == 'mixed_float16':
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        model.compile(optimizer, loss_function, [accuracy_function])
+        train_step = compiled_step(model, AccompanimentModel.train_batch, 0, batch_spec(*batches[0]))
+        eval_step = compiled_step(model, AccompanimentModel.eval_batch, 0, batch_spec(*valid))
+
+        float(train_step(*batches[0])[0])
+        start = time.perf_counter()
+        for i in range(args.steps):
+            loss = train_step(*batches[i % len(batches)])[0]
+        float(loss)
+        elapsed = time.perf_counter() - start
+
+        loss, num_predictions, _ = eval_step(*valid)
+        print(f"{policy:15s} {elapsed / args.steps * 1000:7.1f} ms/step, valid perplexity {np.exp(float(loss / num_predictions)):8.3f}")
+    tf.keras.mixed_precision.set_global_policy('float32')
+
+
+def benchmark_speculative(args):
+    decoder = load_decoder(args.chkpt_path, args.hidden_size)
+    draft_decoder = load_decoder(args.draft_path, args.draft_hidden)
+    melodies = random_melodies(args.samples + 1, decoder.vocab_size)
+
+    # Warm-up so neither side pays for tracing
+    speculative_generate(decoder, draft_decoder, melodies[-1], args.temperature, args.length, args.num_draft, seed=0)
+    generate(decoder, melodies[-1:], args.temperature, [0], args.length)
+
+    proposed = accepted = 0
+    start = time.perf_counter()
+    for i, melody in enumerate(melodies[:-1]):
+        _, stats = speculative_generate(decoder, draft_decoder, melody, args.temperature, args.length, args.num_draft, seed=i)
+        proposed += stats["proposed"]
+        accepted += stats["accepted"]
+    speculative_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i, melody in enumerate(melodies[:-1]):
+        generate(decoder, melody[np.newaxis], args.temperature, [i], args.length)
+    plain_time = time.perf_counter() - start
+
+    print(f"acceptance rate: {accepted / max(proposed, 1):.3f} ({accepted}/{proposed} proposals)")
+    print(f"plain:       {plain_time:.3f}s ({plain_time / args.samples * 1000:.1f} ms/sample)")
+    print(f"speculative: {speculative_time:.3f}s ({speculative_time / args.samples * 1000:.1f} ms/sample)")
+    print(f"speedup:     {plain_time / speculative_time:.2f}x")
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of the process so far (ru_maxrss), plus the device peak when there is a GPU.
+    ru_maxrss never goes down, so the peak of a model size includes the sizes benchmarked before it;
+    benchmark one size per run for isolated numbers.
+    """
+    peak = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if tf.config.list_physical_devices('GPU'):
+        peak["peak_gpu_mb"] = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2**20
+    return peak
+
+
+def time_steps(step, batches, steps):
+    '''Times steps calls of a compiled train/eval step after one warm-up call, returns tokens/sec and ms/step'''
+    start = time.perf_counter()
+    float(step(*batches[0])[1])
+    first_step = time.perf_counter() - start
+
+    num_tokens = 0.0
+    start = time.perf_counter()
+    for i in range(steps):
+        # Predicted tokens are counted on the device and only read back at the end
+        num_tokens += step(*batches[i % len(batches)])[1]
+    num_tokens = float(num_tokens)
+    elapsed = time.perf_counter() - start
+    return {
+        "tokens_per_sec": num_tokens / elapsed,
+        "ms_per_step":    elapsed / steps * 1000,
+        "first_step_s":   first_step,
+    }
+
+
+def generation_latencies(decoder, melodies, length):
+    '''Seconds between the tokens of one generate_stream run, i.e. per-token latency of the batch'''
+    latencies = []
+    start = time.perf_counter()
+    for _ in generate_stream(decoder, melodies, 1.0, list(range(len(melodies))), length):
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    return latencies
+
+
+def run_metadata():
+    '''What the numbers depend on besides the arguments'''
+    try:
+        # e.g. 1a2b3c4-dirty when there are uncommitted changes
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit":      commit,
+        "time":        time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "tensorflow":  tf.__version__,
+        "python":      platform.python_version(),
+        "machine":     platform.machine(),
+        "processor":   platform.processor(),
+        "cpu_count":   os.cpu_count(),
+        "devices":     [device.name for device in tf.config.list_physical_devices()],
+    }
+
+
+def benchmark_suite(args):
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    batches = [random_batch(args.batch_size, seed=i) for i in range(4)]
+    results = []
+    for hidden_size in args.hidden_sizes:
+        tf.random.set_seed(0)
+        decoder = TransformerDecoder(vocab_size=290, hidden_size=hidden_size, window_size=63, num_heads=args.num_heads, fused_attention=args.fused_attention)
+        model = AccompanimentModel(decoder)
+        model.compile(tf.keras.optimizers.Adam(1e-3), loss_function, [accuracy_function], jit_compile=args.jit_compile)
+        train_step = compiled_step(model, AccompanimentModel.train_batch, 0, batch_spec(*batches[0]))
+        eval_step = compiled_step(model, AccompanimentModel.eval_batch, 0, batch_spec(*batches[0]))
+        result = {"hidden_size": hidden_size}
+        result["train"] = time_steps(train_step, batches, args.train_steps)
+        # Known once the first step has built the model
+        result["num_parameters"] = int(sum(np.prod(w.shape) for w in model.trainable_weights))
+        result["eval"] = time_steps(eval_step, batches, args.eval_steps)
+
+        melodies = random_melodies(args.gen_batch * (args.gen_samples + 1))
+        # Warm-up run, so tracing is not timed
+        generation_latencies(decoder, melodies[:args.gen_batch], args.gen_length)
+        latencies = []
+        for i in range(1, args.gen_samples + 1):
+            latencies += generation_latencies(decoder, melodies[i * args.gen_batch:(i + 1) * args.gen_batch], args.gen_length)
+        latencies = np.array(latencies) * 1000
+        result["generation"] = {
+            "p50_ms_per_token": float(np.percentile(latencies, 50)),
+            "p99_ms_per_token": float(np.percentile(latencies, 99)),
+            "tokens_per_sec":   args.gen_batch * len(latencies) / (latencies.sum() / 1000),
+        }
+        result.update(peak_memory_mb())
+        results.append(result)
+        print(f"hidden {hidden_size:5d}: train {result['train']['tokens_per_sec']:9.0f} tok/s, eval {result['eval']['tokens_per_sec']:9.0f} tok/s, "
+              f"generation p50 {result['generation']['p50_ms_per_token']:.2f} / p99 {result['generation']['p99_ms_per_token']:.2f} ms/token, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    tf.keras.mixed_precision.set_global_policy('float32')
+
+    report = {"metadata": run_metadata(), "arguments": vars(args), "results": results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_results(json.load(f), report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def compare_results(baseline, report):
+    '''Prints the ratio of every throughput and latency against a baseline report, by hidden size'''
+    print(f"Against {baseline['metadata']['commit']} ({baseline['metadata']['time']}):")
+    baseline_results = {result["hidden_size"]: result for result in baseline["results"]}
+    for result in report["results"]:
+        before = baseline_results.get(result["hidden_size"])
+        if before is None:
+            continue
+        ratios = [
+            f"{name} {result[section][key] / before[section][key]:.2f}x"
+            for name, section, key in (
+                ("train tok/s", "train", "tokens_per_sec"),
+                ("eval tok/s", "eval", "tokens_per_sec"),
+                ("p50 latency", "generation", "p50_ms_per_token"),
+                ("p99 latency", "generation", "p99_ms_per_token"),
+            )
+        ]
+        print(f"hidden {result['hidden_size']:5d}: " + ", ".join(ratios))
+
+
+def synthetic_remi(vocab, num_notes, seed=0):
+    '''REMI-like token stream: bars (sometimes empty) of Position, Pitch, Velocity, Duration notes, and a few drum notes'''
+    rng = np.random.default_rng(seed)
+    kinds = {kind: kind_ids(vocab, kind) for kind in ('Bar', 'Position', 'Pitch', 'Velocity', 'Duration', 'PitchDrum')}
+    notes = np.stack([
+        rng.choice(kinds['Position'], num_notes),
+        np.where(rng.random(num_notes) < 0.002, rng.choice(kinds['PitchDrum'], num_notes), rng.choice(kinds['Pitch'], num_notes)),
+        rng.choice(kinds['Velocity'], num_notes),
+        rng.choice(kinds['Duration'], num_notes),
+    ], axis=1)
+    tokens = []
+    for bar in np.array_split(notes, num_notes // 4):
+        tokens += [kinds['Bar'][0]] * rng.integers(1, 4)
+        tokens += bar.ravel().tolist()
+    return tokens
+
+
+def loop_filters(ids, bar_id, low_pitches, high_pitches, drums, window_size):
+    '''The list and while loops of the normalizer scripts, with their id ranges given'''
+    ids = [ids[i] for i in range(len(ids)-1) if ids[i] != bar_id or ids[i] != ids[i+1]]
+    kept = []
+    for low, high in (low_pitches, high_pitches):
+        filtered = []
+        i = 0
+        while i < len(ids):
+            if low <= ids[i] <= high:
+                i += 3
+            else:
+                filtered.append(ids[i])
+                i += 1
+        kept.append(filtered)
+    windows = []
+    for sequence in kept:
+        batches = [sequence[i*window_size:(i+1)*window_size] for i in range(len(sequence) // window_size)]
+        windows.append([not any(id in range(*drums) for id in batch) for batch in batches])
+    return ids, kept, windows
+
+
+def array_filters(ids, bar_ids, low_lookup, high_lookup, drum_lookup, window_size):
+    '''The same filters with data_preprocessing/token_filters.py'''
+    ids = dedupe_bars(ids, bar_ids)
+    kept = [drop_notes(ids, low_lookup), drop_notes(ids, high_lookup)]
+    windows = [
+        windows_without(sequence[:len(sequence) // window_size * window_size].reshape(-1, window_size), drum_lookup)
+        for sequence in kept
+    ]
+    return ids, kept, windows
+
+
+def benchmark_filters(args):
+    vocab = REMI(TokenizerConfig(num_velocities=8)).vocab
+    files = [synthetic_remi(vocab, args.notes, seed) for seed in range(args.num_files)]
+    arrays = [np.array(file) for file in files]
+    bar_ids = kind_ids(vocab, 'Bar')
+    # The scripts split at middle C and rejected windows with drums, as contiguous id ranges
+    low, high, drums = pitch_ids(vocab, high=60), pitch_ids(vocab, low=60), kind_ids(vocab, 'PitchDrum')
+    loop_args = (int(bar_ids[0]), (low.min(), low.max()), (high.min(), high.max()), (drums.min(), drums.max() + 1), args.window_size)
+    array_args = (bar_ids, id_lookup(low, vocab), id_lookup(high, vocab), id_lookup(drums, vocab), args.window_size)
+
+    start = time.perf_counter()
+    loop_results = [loop_filters(file, *loop_args) for file in files]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    array_results = [array_filters(file, *array_args) for file in arrays]
+    array_time = time.perf_counter() - start
+
+    # The de-duplication loop also dropped the last token of every file; from there on both give the same
+    for (loop_ids, loop_kept, loop_windows), (ids, _, _) in zip(loop_results, array_results):
+        assert loop_ids == ids[:-1].tolist()
+        _, kept, windows = array_filters(np.array(loop_ids), *array_args)
+        assert [sequence.tolist() for sequence in kept] == loop_kept
+        assert [mask.tolist() for mask in windows] == loop_windows
+    tokens = sum(len(file) for file in files)
+    print(f"{args.num_files} files, {tokens} tokens")
+    print(f"loops      {tokens / loop_time / 1e6:8.2f} M tokens/s ({loop_time / args.num_files * 1000:.1f} ms/file)")
+    print(f"vectorized {tokens / array_time / 1e6:8.2f} M tokens/s ({array_time / args.num_files * 1000:.1f} ms/file), {loop_time / array_time:.0f}x")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    {
+        'speculative': benchmark_speculative,
+        'train_step':  benchmark_train_step,
+        'precision':   benchmark_precision,
+        'suite':       benchmark_suite,
+        'filters':     benchmark_filters,
+    }[args.benchmark](args)
@@ -5,6 +5,11 @@ import os
 from miditok import REMI, TokenizerConfig
 from symusic import Score
 import pickle
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_preprocessing.token_filters import fit_melody
 
 # Converts a single MIDI to a token sequence
 
@@ -18,15 +23,8 @@ count = 0
 final_input_ids = []
 input_score = Score(file_path)
 input_tokens = tokenizer(input_score)[0]
-input_ids = input_tokens.ids
-input_ids = [input_ids[i] for i in range(len(input_ids)-1) if input_ids[i] != 4 or input_ids[i] != input_ids[i+1]]
-
-# Dupe input IDs until it meets correct length
-while len(input_ids) < 64:
-    input_ids.extend(input_ids)
-
-input_ids = input_ids[:64]
-input_ids = [1] + input_ids
+# Same melody input as serve.py and the streaming harmonizer, for a model with 64 melody tokens
+input_ids = fit_melody(input_tokens.ids, tokenizer.vocab, 64)
 
 test_input_ids = [input_ids]
 
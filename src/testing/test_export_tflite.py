@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model.decoder import TransformerDecoder
+from inference.tflite_runtime import TFLiteDecoder
+from export_tflite import convert
+
+# Run with `python -m pytest src/testing` from the root directory
+
+
+def random_pairs(num_pairs, vocab_size=290, window_size=63, melody_length=64, seed=0):
+    '''(melody, harmony) pairs, the harmonies ending in padding like the last window of a file'''
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(num_pairs):
+        harmony = rng.integers(1, vocab_size, window_size)
+        harmony[rng.integers(window_size // 2, window_size):] = 0
+        pairs.append((rng.integers(1, vocab_size, melody_length), harmony))
+    return pairs
+
+
+@pytest.mark.parametrize('quantization', ['dynamic', 'int8'])
+def test_quantized_model_runs_close_to_keras(tmp_path, quantization):
+    tf.keras.utils.set_random_seed(0)
+    decoder = TransformerDecoder(vocab_size=290, hidden_size=32, window_size=63, num_heads=3)
+    pairs = random_pairs(24)
+    decoder(np.array([pairs[0][0]]), np.array([pairs[0][1]]))
+
+    path = str(tmp_path / 'model.tflite')
+    with open(path, 'wb') as f:
+        f.write(convert(decoder, quantization, pairs[:16]))
+    tflite_decoder = TFLiteDecoder(path)
+
+    melodies, captions = (np.array(column) for column in zip(*pairs[16:]))
+    expected = decoder(melodies, captions).numpy()
+    logits = tflite_decoder(melodies, captions)
+
+    assert np.all(np.isfinite(logits))
+    # Near-uniform predictions of an untrained model: argmax ties are easily broken by rounding, probabilities not
+    assert np.abs(tf.nn.softmax(logits) - tf.nn.softmax(expected)).max() < 0.005
+    visible = captions != 0
+    assert (logits.argmax(-1) == expected.argmax(-1))[visible].mean() > 0.8
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model.model import AccompanimentModel
+from model.decoder import TransformerDecoder
+
+# Run with `python -m pytest src/testing` from the root directory
+
+
+@pytest.mark.parametrize('fused_attention, num_heads', [(False, 3), (True, 3), (False, 4)])
+def test_saved_model_loads_with_its_weights(tmp_path, fused_attention, num_heads):
+    model = AccompanimentModel(TransformerDecoder(vocab_size=290, hidden_size=32, window_size=63, num_heads=num_heads, fused_attention=fused_attention))
+    rng = np.random.default_rng(0)
+    melody = rng.integers(1, 290, [2, 64]).astype(np.int32)
+    harmony = rng.integers(1, 290, [2, 63]).astype(np.int32)
+    logits = model(melody, harmony).numpy()
+
+    path = str(tmp_path / 'model.keras')
+    tf.keras.models.save_model(model, path)
+    loaded = tf.keras.models.load_model(
+        path,
+        custom_objects=dict(
+            TransformerDecoder  = TransformerDecoder,
+            AccompanimentModel  = AccompanimentModel,
+        ),
+    )
+
+    assert loaded.decoder.fused_attention == fused_attention
+    assert loaded.decoder.decoder.self_atten.num_heads == num_heads
+    np.testing.assert_array_equal(loaded(melody, harmony).numpy(), logits)